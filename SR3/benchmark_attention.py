@@ -0,0 +1,75 @@
+import torch
+import argparse
+import math
+import multiprocessing as mp
+import resource
+import time
+from model.sr3_modules.unet import SelfAttention
+
+
+def einsum_attention(self, input):
+    '''SelfAttention.forward before the fused path, builds the full bnhwyx score tensor'''
+    batch, channel, height, width = input.shape
+    n_head = self.n_head
+    head_dim = channel // n_head
+
+    norm = self.norm(input)
+    qkv = self.qkv(norm).view(batch, n_head, head_dim * 3, height, width)
+    query, key, value = qkv.chunk(3, dim=2)  # bhdyx
+
+    attn = torch.einsum(
+        "bnchw, bncyx -> bnhwyx", query, key
+    ).contiguous() / math.sqrt(channel)
+    attn = attn.view(batch, n_head, height, width, -1)
+    attn = torch.softmax(attn, -1)
+    attn = attn.view(batch, n_head, height, width, height, width)
+
+    out = torch.einsum("bnhwyx, bncyx -> bnchw", attn, value).contiguous()
+    out = self.out(out.view(batch, channel, height, width))
+
+    return out + input
+
+
+def run(impl, resolution, args, queue):
+    '''one measurement in a fresh process, so the peak RSS only covers this attention call'''
+    torch.manual_seed(0)
+    torch.set_num_threads(args.threads)
+    attn = SelfAttention(args.channel, n_head=args.n_head, norm_groups=args.norm_groups).eval()
+    forward = attn.forward if impl == 'fused' else (lambda x: einsum_attention(attn, x))
+    x = torch.randn(args.batch_size, args.channel, resolution, resolution)
+    with torch.no_grad():
+        forward(x[:1, :, :8, :8])
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        for _ in range(args.repeat):
+            out = forward(x)
+        elapsed = (time.time() - start) / args.repeat
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((elapsed, (peak - base) / 1024., out.numpy()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resolutions', type=int, nargs='+', default=[16, 32, 64])
+    parser.add_argument('--channel', type=int, default=256)
+    parser.add_argument('--n_head', type=int, default=1)
+    parser.add_argument('--norm_groups', type=int, default=32)
+    parser.add_argument('-b', '--batch_size', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    args = parser.parse_args()
+
+    ctx = mp.get_context('spawn')
+    print('# {:>4s} # {:>8s} # {:>12s} # {:>14s} # {:>10s}'.format(
+        'res', 'impl', 'latency (ms)', 'peak mem (MB)', 'max diff'))
+    for resolution in args.resolutions:
+        outputs = {}
+        for impl in ('einsum', 'fused'):
+            queue = ctx.Queue()
+            p = ctx.Process(target=run, args=(impl, resolution, args, queue))
+            p.start()
+            elapsed, peak, outputs[impl] = queue.get()
+            p.join()
+            diff = abs(outputs[impl] - outputs['einsum']).max()
+            print('# {:4d} # {:>8s} # {:12.2f} # {:14.1f} # {:10.2e}'.format(
+                resolution, impl, elapsed * 1000., peak, diff))
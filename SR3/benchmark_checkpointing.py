@@ -0,0 +1,95 @@
+import numpy as np
+import torch
+import argparse
+import logging
+import multiprocessing as mp
+import resource
+import time
+import core.logger as Logger
+import model.networks as networks
+
+
+def run(opt, use_checkpoint, batch_size, args, queue):
+    '''training iterations in a fresh process, so the peak memory only covers this setting'''
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.threads)
+    device = torch.device('cuda' if opt['gpu_ids'] and torch.cuda.is_available() else 'cpu')
+    opt['model']['unet']['use_checkpoint'] = use_checkpoint
+    netG = networks.define_G(opt).to(device).train()
+    netG.set_loss(device)
+    netG.set_new_noise_schedule(opt['model']['beta_schedule']['train'], device)
+    optimizer = torch.optim.Adam(netG.parameters(), lr=opt['train']['optimizer']['lr'])
+    diffusion_opt = opt['model']['diffusion']
+    shape = (batch_size, diffusion_opt['channels'], diffusion_opt['image_size'], diffusion_opt['image_size'])
+    data = {'HR': torch.rand(shape, device=device) * 2 - 1, 'SR': torch.rand(shape, device=device) * 2 - 1}
+
+    # memory on top of the model and the data
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated() / 2 ** 20
+    else:
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+    # gradients from fixed weights and seed, compared across settings
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    netG(data).sum().backward()
+    grad = torch.cat([p.grad.flatten() for p in netG.parameters() if p.grad is not None]).cpu()
+
+    def step():
+        optimizer.zero_grad()
+        loss = netG(data)
+        loss.sum().backward()
+        optimizer.step()
+
+    # the peak includes the optimizer state, allocated by the first step in both settings
+    step()
+    start = time.time()
+    for _ in range(args.repeat):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() / 2 ** 20 - base
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024. - base
+    elapsed = (time.time() - start) / args.repeat
+    queue.put((elapsed, peak, grad.numpy()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', type=str, default='config/custom_train_deblurring.json',
+                        help='JSON file for configuration, only the model part is used')
+    parser.add_argument('-p', '--phase', type=str, choices=['train'], help='Run train(training)', default='train')
+    parser.add_argument('-gpu', '--gpu_ids', type=str, default=None)
+    parser.add_argument('-debug', '-d', action='store_true')
+    parser.add_argument('-enable_wandb', action='store_true')
+    parser.add_argument('-b', '--batch_size', type=int, nargs='+', default=[4, 8, 16])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--seed', type=int, default=0)
+
+    # parse configs
+    args = parser.parse_args()
+    opt = Logger.parse(args)
+    # Convert to NoneDict, which return None for missing key.
+    opt = Logger.dict_to_nonedict(opt)
+
+    Logger.setup_logger(None, opt['path']['log'],
+                        'benchmark', level=logging.INFO, screen=True)
+    logger = logging.getLogger('base')
+
+    # random weights, the memory and speed do not depend on them
+    ctx = mp.get_context('spawn')
+    for batch_size in args.batch_size:
+        grads = {}
+        for use_checkpoint in (False, True):
+            queue = ctx.Queue()
+            p = ctx.Process(target=run, args=(opt, use_checkpoint, batch_size, args, queue))
+            p.start()
+            elapsed, peak, grads[use_checkpoint] = queue.get()
+            p.join()
+            logger.info('# batch {:3d} # checkpoint: {:<5} # peak mem: {:9.1f} MB, sec/iter: {:8.3f}, '
+                        'max grad diff: {:.2e}'.format(
+                            batch_size, str(use_checkpoint), peak, elapsed,
+                            abs(grads[use_checkpoint] - grads[False]).max()))
@@ -0,0 +1,65 @@
+import torch
+import argparse
+import logging
+import core.logger as Logger
+import model.networks as networks
+import time
+from collections import OrderedDict
+
+
+def sample(netG, x, seed):
+    torch.manual_seed(seed)
+    start = time.time()
+    out = netG.super_resolution(x)
+    return out, time.time() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', type=str, default='config/eval_deblurring.json',
+                        help='JSON file for configuration, only the model part is used')
+    parser.add_argument('-p', '--phase', type=str, choices=['val'], help='val(generation)', default='val')
+    parser.add_argument('-gpu', '--gpu_ids', type=str, default=None)
+    parser.add_argument('-debug', '-d', action='store_true')
+    parser.add_argument('-enable_wandb', action='store_true')
+    parser.add_argument('-b', '--batch_size', type=int, default=1)
+    parser.add_argument('--steps', type=int, default=20, help='ddim steps per sampling run')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--mode', type=str, default=None,
+                        help='torch.compile mode, e.g. max-autotune')
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--seed', type=int, default=0)
+
+    # parse configs
+    args = parser.parse_args()
+    opt = Logger.parse(args)
+    # Convert to NoneDict, which return None for missing key.
+    opt = Logger.dict_to_nonedict(opt)
+
+    Logger.setup_logger(None, opt['path']['log'],
+                        'benchmark', level=logging.INFO, screen=True)
+    logger = logging.getLogger('base')
+    torch.set_num_threads(args.threads)
+
+    # random weights, the speed does not depend on them
+    netG = networks.define_G(opt).eval()
+    schedule_opt = OrderedDict(opt['model']['beta_schedule']['val'])
+    schedule_opt.update({'sampler': 'ddim', 'sample_steps': args.steps, 'timesteps': None,
+                         'strength': 1.0, 'early_stop_threshold': 0.})
+    netG.set_new_noise_schedule(schedule_opt, torch.device('cpu'))
+    diffusion_opt = opt['model']['diffusion']
+    x = torch.randn(args.batch_size, diffusion_opt['channels'],
+                    diffusion_opt['image_size'], diffusion_opt['image_size'])
+
+    results = OrderedDict()
+    for name in ('eager', 'compiled'):
+        if name == 'compiled':
+            netG.compile_denoiser(args.mode)
+        # the first run of the compiled denoiser includes the compilation
+        out, warmup = sample(netG, x, args.seed)
+        elapsed = min(sample(netG, x, args.seed)[1] for _ in range(args.repeat))
+        results[name] = out
+        logger.info('# {:<8s} # first run: {:8.2f} s, steps/sec: {:8.2f}, max diff: {:.2e}'.format(
+            name, warmup, args.steps / elapsed, (out - results['eager']).abs().max().item()))
+    if netG.compiled_denoise_fn is None:
+        logger.info('torch.compile was not used, see the warning above.')
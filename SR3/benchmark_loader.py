@@ -0,0 +1,64 @@
+import data as Data
+import argparse
+import core.logger as Logger
+import time
+import itertools
+from collections import OrderedDict
+
+
+def throughput(loader, epochs):
+    '''samples per second over whole epochs, after a first epoch that starts the workers'''
+    for _ in loader:
+        pass
+    n = 0
+    start = time.time()
+    for _ in range(epochs):
+        for batch in loader:
+            n += batch['HR'].shape[0]
+    return n / (time.time() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataroot', type=str, nargs='+', required=True,
+                        help='datasets as datatype:path, e.g. img:dataset/train_camus npy:dataset/train_camus '
+                             'lmdb:dataset/train_camus_lmdb')
+    parser.add_argument('--l_resolution', type=int, default=128)
+    parser.add_argument('--r_resolution', type=int, default=128)
+    parser.add_argument('--channels', type=int, default=3)
+    parser.add_argument('--mode', type=str, choices=['HR', 'LRHR'], default='HR')
+    parser.add_argument('--phase', type=str, choices=['train', 'val'], default='train',
+                        help='train reads with augmentation and shuffling')
+    parser.add_argument('-b', '--batch_size', type=int, default=4)
+    parser.add_argument('--num_workers', type=int, nargs='+', default=[0, 4])
+    parser.add_argument('--data_len', type=int, default=-1)
+    parser.add_argument('--epochs', type=int, default=3)
+    parser.add_argument('--cache', action='store_true',
+                        help='also read every dataset from the shared-memory cache')
+    parser.add_argument('--batch_augment', action='store_true',
+                        help='also augment and scale whole batches in the collate_fn')
+    parser.add_argument('--rot_augment', action='store_true',
+                        help='flips and transposes instead of horizontal flips only')
+    args = parser.parse_args()
+
+    print('# {:>16s} # {:>7s} # {:>11s} # {:>12s}'.format('type', 'workers', 'samples/sec', 'speedup'))
+    for num_workers in args.num_workers:
+        results = OrderedDict()
+        for spec in args.dataroot:
+            for cache, batch_augment in itertools.product(
+                    (False, True) if args.cache else (False,), (False, True) if args.batch_augment else (False,)):
+                datatype, dataroot = spec.split(':', 1)
+                dataset_opt = Logger.dict_to_nonedict({
+                    'name': dataroot, 'mode': args.mode, 'dataroot': dataroot, 'datatype': datatype,
+                    'l_resolution': args.l_resolution, 'r_resolution': args.r_resolution,
+                    'batch_size': args.batch_size, 'num_workers': num_workers, 'use_shuffle': True,
+                    'data_len': args.data_len, 'channels': args.channels, 'cache': cache,
+                    'batch_augment': batch_augment, 'rot_augment': args.rot_augment})
+                dataset = Data.create_dataset(dataset_opt, args.phase)
+                loader = Data.create_dataloader(dataset, dataset_opt, args.phase)
+                name = datatype + ('+cache' if cache else '') + ('+batch' if batch_augment else '')
+                results[name] = throughput(loader, args.epochs)
+                print('# {:>16s} # {:7d} # {:11.1f} # {:11.2f}x'.format(
+                    name, num_workers, results[name], results[name] / next(iter(results.values()))))
+                # lmdb allows a single environment per path and process
+                del loader, dataset
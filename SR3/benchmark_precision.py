@@ -0,0 +1,55 @@
+import torch
+import torch.nn as nn
+import data as Data
+import model as Model
+import argparse
+import logging
+import core.logger as Logger
+from benchmark_sampling import evaluate
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', type=str, default='config/eval_deblurring.json',
+                        help='JSON file for configuration')
+    parser.add_argument('-p', '--phase', type=str, choices=['val'], help='val(generation)', default='val')
+    parser.add_argument('-gpu', '--gpu_ids', type=str, default=None)
+    parser.add_argument('-debug', '-d', action='store_true')
+    parser.add_argument('-enable_wandb', action='store_true')
+    parser.add_argument('--data_len', type=int, default=-1,
+                        help='number of test images used, -1 for the whole split')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--modes', type=str, nargs='+',
+                        default=['fp32', 'fp32:channels_last', 'bf16', 'bf16:channels_last'],
+                        help='precision[:channels_last] settings, compared with the first one')
+
+    # parse configs
+    args = parser.parse_args()
+    opt = Logger.parse(args)
+    opt['datasets']['val']['data_len'] = args.data_len
+    # Convert to NoneDict, which return None for missing key.
+    opt = Logger.dict_to_nonedict(opt)
+
+    Logger.setup_logger(None, opt['path']['log'],
+                        'benchmark', level=logging.INFO, screen=True)
+    logger = logging.getLogger('base')
+    torch.set_num_threads(args.threads)
+
+    val_set = Data.create_dataset(opt['datasets']['val'], 'val')
+    val_loader = Data.create_dataloader(val_set, opt['datasets']['val'], 'val')
+    diffusion = Model.create_model(opt)
+    network = diffusion.netG.module if isinstance(diffusion.netG, nn.DataParallel) else diffusion.netG
+    diffusion.set_new_noise_schedule(opt['model']['beta_schedule']['val'], schedule_phase='val')
+
+    logger.info('Comparing {} settings on {} images with {} threads.'.format(
+        len(args.modes), len(val_set), args.threads))
+    reference = None
+    for mode in args.modes:
+        spec = mode.split(':')
+        network.set_inference(spec[0], 'channels_last' in spec[1:])
+        psnr, ssim, _, seconds = evaluate(diffusion, val_loader, args.seed)
+        if reference is None:
+            reference = (psnr, ssim, seconds)
+        logger.info('# {:<20s} # img/sec: {:7.3f} ({:.2f}x), PSNR: {:.4e} ({:+.2e}), SSIM: {:.4e} ({:+.2e})'.format(
+            mode, 1. / seconds, reference[2] / seconds, psnr, psnr - reference[0], ssim, ssim - reference[1]))
@@ -0,0 +1,108 @@
+import torch
+import data as Data
+import model as Model
+import argparse
+import itertools
+import logging
+import core.logger as Logger
+import core.metrics as Metrics
+import time
+from collections import OrderedDict
+
+
+def evaluate(diffusion, val_loader, seed=0):
+    '''run the val split with the current schedule, return psnr, ssim, steps and seconds per image'''
+    torch.manual_seed(seed)
+    avg_psnr = 0.0
+    avg_ssim = 0.0
+    steps = 0
+    elapsed = 0.0
+    idx = 0
+    for _,  val_data in enumerate(val_loader):
+        diffusion.feed_data(val_data)
+        start = time.time()
+        diffusion.test(continous=False)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        elapsed += time.time() - start
+        visuals = diffusion.get_current_visuals()
+        sr_imgs = Metrics.tensor2imgs(visuals['SR'])  # uint8
+        hr_imgs = Metrics.tensor2imgs(visuals['HR'])  # uint8
+        for sr_img, hr_img, n_steps in zip(sr_imgs, hr_imgs, diffusion.get_sample_steps()):
+            idx += 1
+            avg_psnr += Metrics.calculate_psnr(sr_img, hr_img)
+            avg_ssim += Metrics.calculate_ssim(sr_img, hr_img)
+            steps += n_steps
+    return avg_psnr / idx, avg_ssim / idx, steps / idx, elapsed / idx
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', type=str, default='config/eval_deblurring.json',
+                        help='JSON file for configuration')
+    parser.add_argument('-p', '--phase', type=str, choices=['val'], help='val(generation)', default='val')
+    parser.add_argument('-gpu', '--gpu_ids', type=str, default=None)
+    parser.add_argument('-debug', '-d', action='store_true')
+    parser.add_argument('-enable_wandb', action='store_true')
+    parser.add_argument('--data_len', type=int, default=-1,
+                        help='number of val images used, -1 for the whole split')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sampler', type=str, nargs='+', default=None,
+                        help='samplers as name:steps[:spacing], e.g. ddpm:2000 ddim:50 dpm_solver:20:logsnr, '
+                             'defaults to the sampler of the val schedule')
+    parser.add_argument('--strength', type=float, nargs='+', default=[1.0],
+                        help='fractions of the reverse process to run, 1.0 starts from pure noise')
+    parser.add_argument('--early_stop', type=float, nargs='+', default=None,
+                        help='early stopping thresholds on the change of the x_0 estimate, 0 disables it, '
+                             'defaults to the threshold of the val schedule')
+    parser.add_argument('--deep_cache', type=str, nargs='+', default=None,
+                        help='deep feature reuse as interval[:levels], e.g. 1 2 3:2, 1 disables it, '
+                             'defaults to the deep cache of the val schedule')
+
+    # parse configs
+    args = parser.parse_args()
+    opt = Logger.parse(args)
+    opt['datasets']['val']['data_len'] = args.data_len
+    # Convert to NoneDict, which return None for missing key.
+    opt = Logger.dict_to_nonedict(opt)
+
+    Logger.setup_logger(None, opt['path']['log'],
+                        'benchmark', level=logging.INFO, screen=True)
+    logger = logging.getLogger('base')
+
+    val_set = Data.create_dataset(opt['datasets']['val'], 'val')
+    val_loader = Data.create_dataloader(val_set, opt['datasets']['val'], 'val')
+    diffusion = Model.create_model(opt)
+
+    settings = []
+    for sampler in (args.sampler or [None]):
+        for strength in args.strength:
+            for early_stop, deep_cache in itertools.product(args.early_stop or [None], args.deep_cache or [None]):
+                schedule_opt = OrderedDict(opt['model']['beta_schedule']['val'])
+                schedule_opt['strength'] = strength
+                name = 'strength={:g}'.format(strength)
+                if sampler is not None:
+                    spec = sampler.split(':')
+                    schedule_opt['sampler'] = spec[0]
+                    if len(spec) > 1:
+                        schedule_opt['sample_steps'] = int(spec[1])
+                    if len(spec) > 2:
+                        schedule_opt['timestep_spacing'] = spec[2]
+                    name = '{} {}'.format(sampler, name)
+                if early_stop is not None:
+                    schedule_opt['early_stop_threshold'] = early_stop
+                    name = '{} early_stop={:g}'.format(name, early_stop)
+                if deep_cache is not None:
+                    spec = deep_cache.split(':')
+                    schedule_opt['deep_cache_interval'] = int(spec[0])
+                    if len(spec) > 1:
+                        schedule_opt['deep_cache_levels'] = int(spec[1])
+                    name = '{} deep_cache={}'.format(name, deep_cache)
+                settings.append((name, schedule_opt))
+
+    logger.info('Benchmarking {} settings on {} images.'.format(len(settings), len(val_set)))
+    for name, schedule_opt in settings:
+        diffusion.set_new_noise_schedule(schedule_opt, schedule_phase=name)
+        psnr, ssim, steps, seconds = evaluate(diffusion, val_loader, args.seed)
+        logger.info('# {:<48s} # steps: {:7.1f}, sec/img: {:8.3f}, PSNR: {:.4e}, SSIM: {:.4e}'.format(
+            name, steps, seconds, psnr, ssim))
@@ -0,0 +1,52 @@
+import torch
+import argparse
+import os
+
+
+def fold_first_conv(weight, groups):
+    '''
+    [C_out, groups * 3, k, k] -> [C_out, groups, k, k]. A grayscale image fed as three
+    identical channels gives the same response as the sum of the three channel weights.
+    '''
+    c_out, c_in = weight.shape[:2]
+    return weight.view(c_out, groups, c_in // groups, *weight.shape[2:]).sum(dim=2)
+
+
+def fold_last_conv(weight, bias):
+    '''[3, C, k, k], [3] -> [1, C, k, k], [1], the grayscale output is the mean of the RGB outputs'''
+    return weight.mean(dim=0, keepdim=True), bias.mean(dim=0, keepdim=True)
+
+
+def convert(state_dict, rgb_channels=3):
+    first = 'denoise_fn.downs.0.weight'
+    last = 'denoise_fn.final_conv.block.3'
+    groups = state_dict[first].shape[1] // rgb_channels
+    state_dict[first] = fold_first_conv(state_dict[first], groups)
+    state_dict[last + '.weight'], state_dict[last + '.bias'] = fold_last_conv(
+        state_dict[last + '.weight'], state_dict[last + '.bias'])
+    return state_dict, groups
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--checkpoint', type=str, required=True,
+                        help='RGB checkpoint, same format as path.resume_state (without _gen.pth)')
+    parser.add_argument('-o', '--out', type=str, required=True,
+                        help='grayscale checkpoint to write (without _gen.pth)')
+    args = parser.parse_args()
+
+    state_dict = torch.load('{}_gen.pth'.format(args.checkpoint), map_location='cpu')
+    state_dict, groups = convert(state_dict)
+    out_dir = os.path.dirname(args.out)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    torch.save(state_dict, '{}_gen.pth'.format(args.out))
+
+    # keep the training position but not the optimizer, whose moments have the RGB shapes
+    opt_path = '{}_opt.pth'.format(args.checkpoint)
+    opt_state = torch.load(opt_path, map_location='cpu') if os.path.exists(opt_path) else \
+        {'epoch': 0, 'iter': 0, 'scheduler': None}
+    opt_state['optimizer'] = None
+    torch.save(opt_state, '{}_opt.pth'.format(args.out))
+
+    print('Saved grayscale checkpoint {} (unet in_channel: {}, out_channel: 1)'.format(args.out, groups))
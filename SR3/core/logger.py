@@ -69,6 +69,10 @@ def parse(args):
         opt['datasets']['train']['data_len'] = 6
         opt['datasets']['val']['data_len'] = 3
 
+    # datasets load images with the channels of the model, 1 for grayscale
+    for dataset in opt['datasets'].values():
+        dataset.setdefault('channels', opt['model']['diffusion']['channels'])
+
     # validation in train phase
     if phase == 'train':
         opt['datasets']['val']['data_len'] = 3
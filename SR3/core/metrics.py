@@ -11,7 +11,13 @@ def tensor2img(tensor, out_type=np.uint8, min_max=(-1, 1)):
     Input: 4D(B,(3/1),H,W), 3D(C,H,W), or 2D(H,W), any range, RGB channel order
     Output: 3D(H,W,C) or 2D(H,W), [0,255], np.uint8 (default)
     '''
-    tensor = tensor.squeeze().float().cpu().clamp_(*min_max)  # clamp
+    tensor = tensor.float().cpu().clamp_(*min_max)  # clamp
+    # squeeze the batch and channel dims of single images, keeping the
+    # channel dim of a batch of grayscale images
+    if tensor.dim() == 4 and len(tensor) == 1:
+        tensor = tensor[0]
+    if tensor.dim() == 3 and len(tensor) == 1:
+        tensor = tensor[0]
     tensor = (tensor - min_max[0]) / \
         (min_max[1] - min_max[0])  # to range [0,1]
     n_dim = tensor.dim()
@@ -20,6 +26,9 @@ def tensor2img(tensor, out_type=np.uint8, min_max=(-1, 1)):
         img_np = make_grid(tensor, nrow=int(
             math.sqrt(n_img)), normalize=False).numpy()
         img_np = np.transpose(img_np, (1, 2, 0))  # HWC, RGB
+        if tensor.shape[1] == 1:
+            # make_grid repeats grayscale images over 3 channels
+            img_np = img_np[:, :, 0]
     elif n_dim == 3:
         img_np = tensor.numpy()
         img_np = np.transpose(img_np, (1, 2, 0))  # HWC, RGB
@@ -34,7 +43,29 @@ def tensor2img(tensor, out_type=np.uint8, min_max=(-1, 1)):
     return img_np.astype(out_type)
 
 
+def tensor2imgs(tensor, out_type=np.uint8, min_max=(-1, 1)):
+    '''
+    Converts a batched torch Tensor into a list of image Numpy arrays, one per image
+    Input: 4D(B,(3/1),H,W), any range, RGB channel order
+    Output: list of 3D(H,W,C) or 2D(H,W), [0,255], np.uint8 (default)
+    '''
+    tensor = tensor.float().cpu().clamp(*min_max)  # clamp
+    tensor = (tensor - min_max[0]) / \
+        (min_max[1] - min_max[0])  # to range [0,1]
+    img_np = np.transpose(tensor.numpy(), (0, 2, 3, 1))  # BHWC, RGB
+    if out_type == np.uint8:
+        img_np = (img_np * 255.0).round()
+    img_np = img_np.astype(out_type)
+    if img_np.shape[3] == 1:
+        img_np = img_np[:, :, :, 0]
+    return list(img_np)
+
+
 def save_img(img, img_path, mode='RGB'):
+    if img.ndim == 2:
+        # grayscale
+        cv2.imwrite(img_path, img)
+        return
     cv2.imwrite(img_path, cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
     # cv2.imwrite(img_path, img)
 
@@ -1,14 +1,47 @@
 from io import BytesIO
+import json
 import lmdb
+import numpy as np
+import os
+import torch
 from PIL import Image
 from torch.utils.data import Dataset
-import random
 import data.util as Util
 
 
+def lmdb_suffixes(txn, prefix):
+    '''suffixes of the keys that start with prefix, read from the key index only'''
+    cursor = txn.cursor()
+    suffixes = []
+    if cursor.set_range(prefix):
+        for key in cursor.iternext(keys=True, values=False):
+            if not key.startswith(prefix):
+                break
+            suffixes.append(key[len(prefix):])
+    return suffixes
+
+
+def to_uint8_tensor(img):
+    if isinstance(img, torch.Tensor):
+        return img
+    img = np.array(img)
+    return torch.from_numpy(img[None] if img.ndim == 2 else np.ascontiguousarray(img.transpose(2, 0, 1)))
+
+
 class LRHRDataset(Dataset):
-    def __init__(self, dataroot, datatype, l_resolution=16, r_resolution=128, split='train', data_len=-1, need_LR=False):
+    def __init__(self, dataroot, datatype, l_resolution=16, r_resolution=128, split='train', data_len=-1, need_LR=False,
+                 channels=3, batch_augment=False, motion_blur=None):
         self.datatype = datatype
+        # grayscale images are loaded with a single channel
+        self.mode = 'L' if channels == 1 else 'RGB'
+        self.channels = channels
+        # uint8 tensors of the whole split, filled by cache_in_memory
+        self.cache = None
+        # items are uint8 frames, augmented and scaled per batch by Util.BatchAugment
+        self.batch_augment = batch_augment
+        # only the HR frames are read and the SR/LR condition is blurred on the fly,
+        # {'lengths': [...], 'angles': [...], 'exposure': 1, 'seed': None}
+        self.motion_blur = motion_blur
         self.l_res = l_resolution
         self.r_res = r_resolution
         self.data_len = data_len
@@ -16,21 +49,35 @@ class LRHRDataset(Dataset):
         self.split = split
 
         if datatype == 'lmdb':
-            self.env = lmdb.open(dataroot, readonly=True, lock=False,
-                                 readahead=False, meminit=False)
-            # init the datalen
-            with self.env.begin(write=False) as txn:
-                self.dataset_len = int(txn.get("length".encode("utf-8")))
+            self.dataroot = dataroot
+            # opened lazily by every process that reads from it, a handle inherited
+            # through fork is not safe to use in the DataLoader workers
+            self.env = None
+            self.env_pid = None
+            prefixes = ['hr_{}_'.format(r_resolution), 'sr_{}_{}_'.format(l_resolution, r_resolution)]
+            if self.motion_blur:
+                prefixes = prefixes[:1]
+            elif self.need_LR:
+                prefixes.append('lr_{}_'.format(l_resolution))
+            prefixes = [prefix.encode('utf-8') for prefix in prefixes]
+            # key table of the frames that have every image, built once instead of per item
+            with self.open_env().begin(write=False) as txn:
+                valid = set.intersection(*[set(lmdb_suffixes(txn, prefix)) for prefix in prefixes])
+            self.env.close()
+            self.env = None
+            self.keys = [tuple(prefix + suffix for prefix in prefixes) for suffix in sorted(valid)]
+            self.dataset_len = len(self.keys)
             if self.data_len <= 0:
                 self.data_len = self.dataset_len
             else:
                 self.data_len = min(self.data_len, self.dataset_len)
         elif datatype == 'img':
-            self.sr_path = Util.get_paths_from_images(
-                '{}/sr_{}_{}'.format(dataroot, l_resolution, r_resolution))
             self.hr_path = Util.get_paths_from_images(
                 '{}/hr_{}'.format(dataroot, r_resolution))
-            if self.need_LR:
+            if not self.motion_blur:
+                self.sr_path = Util.get_paths_from_images(
+                    '{}/sr_{}_{}'.format(dataroot, l_resolution, r_resolution))
+            if self.need_LR and not self.motion_blur:
                 self.lr_path = Util.get_paths_from_images(
                     '{}/lr_{}'.format(dataroot, l_resolution))
             self.dataset_len = len(self.hr_path)
@@ -38,6 +85,28 @@ class LRHRDataset(Dataset):
                 self.data_len = self.dataset_len
             else:
                 self.data_len = min(self.data_len, self.dataset_len)
+        elif datatype == 'npy':
+            # uint8 N x C x H x W arrays written by prepare_data.pack_npy, memory-mapped
+            # lazily by every process that reads from them
+            self.dataroot = dataroot
+            self.arrays = None
+            self.arrays_pid = None
+            self.array_names = ['hr_{}'.format(r_resolution), 'sr_{}_{}'.format(l_resolution, r_resolution)]
+            if self.motion_blur:
+                self.array_names = self.array_names[:1]
+            elif self.need_LR:
+                self.array_names.append('lr_{}'.format(l_resolution))
+            with open(os.path.join(dataroot, 'index.json')) as f:
+                index = json.load(f)
+            # single channel arrays are served as any number of identical channels
+            assert index['channels'] in (1, channels), \
+                '{} holds {}-channel images, pack it again with --channels {}'.format(
+                    dataroot, index['channels'], channels)
+            self.dataset_len = len(index['names'])
+            if self.data_len <= 0:
+                self.data_len = self.dataset_len
+            else:
+                self.data_len = min(self.data_len, self.dataset_len)
         else:
             raise NotImplementedError(
                 'data_type [{:s}] is not recognized.'.format(datatype))
@@ -45,55 +114,115 @@ class LRHRDataset(Dataset):
     def __len__(self):
         return self.data_len
 
-    def __getitem__(self, index):
-        img_HR = None
-        img_LR = None
+    def open_env(self):
+        self.env = lmdb.open(self.dataroot, readonly=True, lock=False,
+                             readahead=False, meminit=False)
+        self.env_pid = os.getpid()
+        return self.env
+
+    def open_arrays(self):
+        # copy-on-write maps are writable, so torch.from_numpy takes them without a copy
+        self.arrays = [np.load(os.path.join(self.dataroot, '{}.npy'.format(name)), mmap_mode='c')
+                       for name in self.array_names]
+        self.arrays_pid = os.getpid()
+
+    def __getstate__(self):
+        # spawned workers get the dataset pickled, without the environment or the maps
+        state = self.__dict__.copy()
+        for key in ('env', 'arrays'):
+            if key in state:
+                state[key] = None
+        return state
 
+    def load_images(self, index):
+        '''[HR, SR] (+ LR) of a frame before augmentation, as PIL images or uint8 CHW tensors, [HR] with motion_blur'''
+        if self.cache is not None:
+            return [images[index] for images in self.cache]
         if self.datatype == 'lmdb':
+            if self.env is None or self.env_pid != os.getpid():
+                self.open_env()
             with self.env.begin(write=False) as txn:
-                hr_img_bytes = txn.get(
-                    'hr_{}_{}'.format(
-                        self.r_res, str(index).zfill(5)).encode('utf-8')
-                )
-                sr_img_bytes = txn.get(
-                    'sr_{}_{}_{}'.format(
-                        self.l_res, self.r_res, str(index).zfill(5)).encode('utf-8')
-                )
-                if self.need_LR:
-                    lr_img_bytes = txn.get(
-                        'lr_{}_{}'.format(
-                            self.l_res, str(index).zfill(5)).encode('utf-8')
-                    )
-                # skip the invalid index
-                while (hr_img_bytes is None) or (sr_img_bytes is None):
-                    new_index = random.randint(0, self.data_len-1)
-                    hr_img_bytes = txn.get(
-                        'hr_{}_{}'.format(
-                            self.r_res, str(new_index).zfill(5)).encode('utf-8')
-                    )
-                    sr_img_bytes = txn.get(
-                        'sr_{}_{}_{}'.format(
-                            self.l_res, self.r_res, str(new_index).zfill(5)).encode('utf-8')
-                    )
-                    if self.need_LR:
-                        lr_img_bytes = txn.get(
-                            'lr_{}_{}'.format(
-                                self.l_res, str(new_index).zfill(5)).encode('utf-8')
-                        )
-                img_HR = Image.open(BytesIO(hr_img_bytes)).convert("RGB")
-                img_SR = Image.open(BytesIO(sr_img_bytes)).convert("RGB")
-                if self.need_LR:
-                    img_LR = Image.open(BytesIO(lr_img_bytes)).convert("RGB")
+                return [Image.open(BytesIO(txn.get(key))).convert(self.mode)
+                        for key in self.keys[index]]
+        elif self.datatype == 'npy':
+            if self.arrays is None or self.arrays_pid != os.getpid():
+                self.open_arrays()
+            return [torch.from_numpy(array[index]).expand(self.channels, -1, -1)
+                    for array in self.arrays]
+        elif self.motion_blur:
+            return [Image.open(self.hr_path[index]).convert(self.mode)]
         else:
-            img_HR = Image.open(self.hr_path[index]).convert("RGB")
-            img_SR = Image.open(self.sr_path[index]).convert("RGB")
-            if self.need_LR:
-                img_LR = Image.open(self.lr_path[index]).convert("RGB")
+            paths = [self.hr_path, self.sr_path] + ([self.lr_path] if self.need_LR else [])
+            return [Image.open(path[index]).convert(self.mode) for path in paths]
+
+    def cache_size(self):
+        '''bytes needed by cache_in_memory'''
+        size = self.data_len * sum(to_uint8_tensor(img).numel() for img in self.load_images(0))
+        # the parent keeps no handle when the cache is refused, the workers open their own
+        self.close_source()
+        return size
+
+    def close_source(self):
+        if self.datatype == 'lmdb' and self.env is not None:
+            self.env.close()
+            self.env = None
+        elif self.datatype == 'npy':
+            self.arrays = None
+
+    def cache_in_memory(self):
+        '''
+        Decode the whole split once into uint8 tensors in shared memory. DataLoader workers,
+        forked or spawned, read the same tensors, so the split is held in RAM only once.
+        '''
+        first = [to_uint8_tensor(img) for img in self.load_images(0)]
+        cache = [torch.empty((self.data_len,) + tuple(img.shape), dtype=torch.uint8).share_memory_()
+                 for img in first]
+        for index in range(self.data_len):
+            for images, img in zip(cache, self.load_images(index)):
+                images[index] = to_uint8_tensor(img)
+        self.cache = cache
+        # the source is not read again
+        self.close_source()
+
+    def blur_images(self, img_HR, index):
+        '''
+        [HR, SR] (+ LR) with the SR condition blurred from HR like Apply_Motion_Blur.py, with a
+        length and an angle drawn from the configured lists. Without a seed every read draws
+        a new blur from the torch RNG, which the DataLoader seeds per worker; with a seed the
+        blur of a frame is fixed.
+        '''
+        img_HR = to_uint8_tensor(img_HR)
+        generator = None
+        if self.motion_blur['seed'] is not None:
+            generator = torch.Generator().manual_seed(self.motion_blur['seed'] + index)
+        lengths, angles = self.motion_blur['lengths'], self.motion_blur['angles']
+        length = lengths[torch.randint(len(lengths), (), generator=generator)]
+        angle = angles[torch.randint(len(angles), (), generator=generator)]
+        img_SR = Util.motion_blur(img_HR[None], [length], [angle], self.motion_blur['exposure'] or 1)[0]
+        if not self.need_LR:
+            return [img_HR, img_SR]
+        img_LR = img_SR
+        if self.l_res != self.r_res:
+            img_LR = torch.nn.functional.interpolate(
+                img_SR[None].float(), size=(self.l_res, self.l_res), mode='bicubic',
+                antialias=True)[0].round().clamp(0, 255).to(torch.uint8)
+        return [img_HR, img_SR, img_LR]
+
+    def __getitem__(self, index):
+        images = self.load_images(index)
+        if self.motion_blur:
+            images = self.blur_images(images[0], index)
+        if self.batch_augment:
+            item = dict(zip(['HR', 'SR', 'LR'], [to_uint8_tensor(img) for img in images]))
+            item['Index'] = index
+            return item
         if self.need_LR:
+            img_HR, img_SR, img_LR = images
             [img_LR, img_SR, img_HR] = Util.transform_augment(
                 [img_LR, img_SR, img_HR], split=self.split, min_max=(-1, 1))
             return {'LR': img_LR, 'HR': img_HR, 'SR': img_SR, 'Index': index}
         else:
+            img_HR, img_SR = images
             [img_SR, img_HR] = Util.transform_augment(
                 [img_SR, img_HR], split=self.split, min_max=(-1, 1))
             return {'HR': img_HR, 'SR': img_SR, 'Index': index}
@@ -1,21 +1,35 @@
 '''create dataset and dataloader'''
 import logging
+import os
+import shutil
 from re import split
 import torch.utils.data
 
 
 def create_dataloader(dataset, dataset_opt, phase):
     '''create dataloader '''
+    from data.util import BatchAugment
+    collate_fn = BatchAugment(phase, rot=bool(dataset_opt['rot_augment'])) \
+        if dataset_opt['batch_augment'] else None
     if phase == 'train':
         return torch.utils.data.DataLoader(
             dataset,
             batch_size=dataset_opt['batch_size'],
             shuffle=dataset_opt['use_shuffle'],
             num_workers=dataset_opt['num_workers'],
+            # workers keep their dataset state, e.g. the lmdb environment, across epochs
+            persistent_workers=bool(dataset_opt['num_workers']),
+            collate_fn=collate_fn,
             pin_memory=True)
     elif phase == 'val':
         return torch.utils.data.DataLoader(
-            dataset, batch_size=1, shuffle=False, num_workers=1, pin_memory=True)
+            dataset,
+            batch_size=dataset_opt['batch_size'] or 1,
+            shuffle=False,
+            num_workers=dataset_opt['num_workers'] or 1,
+            persistent_workers=True,
+            collate_fn=collate_fn,
+            pin_memory=True)
     else:
         raise NotImplementedError(
             'Dataloader [{:s}] is not found.'.format(phase))
@@ -31,9 +45,29 @@ def create_dataset(dataset_opt, phase):
                 r_resolution=dataset_opt['r_resolution'],
                 split=phase,
                 data_len=dataset_opt['data_len'],
-                need_LR=(mode == 'LRHR')
+                need_LR=(mode == 'LRHR'),
+                channels=dataset_opt['channels'] or 3,
+                batch_augment=bool(dataset_opt['batch_augment']),
+                motion_blur=dataset_opt['motion_blur']
                 )
     logger = logging.getLogger('base')
     logger.info('Dataset [{:s} - {:s}] is created.'.format(dataset.__class__.__name__,
                                                            dataset_opt['name']))
+    if dataset_opt['cache']:
+        budget = dataset_opt['cache_budget_mb'] or 4096
+        size = dataset.cache_size() / 2 ** 20
+        # shared tensors live in /dev/shm, which is small in some containers
+        shm = shutil.disk_usage('/dev/shm').free / 2 ** 20 if os.path.isdir('/dev/shm') else None
+        if shm is not None and size > shm:
+            logger.warning('Dataset [{:s}] needs {:.1f} MB, only {:.1f} MB of shared memory are free, '
+                           'it is read from {:s} instead.'.format(dataset_opt['name'], size, shm,
+                                                                 dataset_opt['datatype']))
+        elif size > budget:
+            logger.warning('Dataset [{:s}] needs {:.1f} MB, above the cache budget of {:d} MB, '
+                           'it is read from {:s} instead.'.format(dataset_opt['name'], size, budget,
+                                                                 dataset_opt['datatype']))
+        else:
+            dataset.cache_in_memory()
+            logger.info('Dataset [{:s}] is cached in shared memory: {:.1f} MB of {:d} MB budget.'.format(
+                dataset_opt['name'], size, budget))
     return dataset
@@ -9,6 +9,7 @@ from tqdm import tqdm
 from torchvision.transforms import functional as trans_fn
 import os
 from pathlib import Path
+import json
 import lmdb
 import numpy as np
 import time
@@ -158,6 +159,35 @@ def prepare(img_path, out_path, n_worker, sizes=(16, 128), resample=Image.BICUBI
                 with env.begin(write=True) as txn:
                     txn.put('length'.encode('utf-8'), str(total).encode('utf-8'))
 
+def pack_npy(out_path, sizes=(16, 128), channels=3, need_LR=True):
+    '''
+    Pack the png folders of a prepared split into uint8 N x C x H x W arrays, one .npy
+    per folder next to them, plus index.json with the frame names in array order.
+    The arrays are written through a memmap, so the split never has to fit in memory.
+    '''
+    mode = 'L' if channels == 1 else 'RGB'
+    folders = ['hr_{}'.format(sizes[1]), 'sr_{}_{}'.format(sizes[0], sizes[1])]
+    if need_LR:
+        folders.append('lr_{}'.format(sizes[0]))
+    # same pairing as the img datatype, sorted paths of every folder
+    paths = {folder: sorted(p for p in Path('{}/{}'.format(out_path, folder)).glob('*')
+                            if p.suffix.lower() == '.png') for folder in folders}
+    names = [p.stem for p in paths[folders[0]]]
+    for folder in folders:
+        assert len(paths[folder]) == len(names), \
+            '{}/{} has {} images, expected {}'.format(out_path, folder, len(paths[folder]), len(names))
+        size = Image.open(paths[folder][0]).size
+        array = np.lib.format.open_memmap('{}/{}.npy'.format(out_path, folder), mode='w+', dtype=np.uint8,
+                                          shape=(len(names), channels, size[1], size[0]))
+        for i, path in enumerate(tqdm(paths[folder], desc='packing {}'.format(folder))):
+            img = np.asarray(Image.open(path).convert(mode))
+            array[i] = img[None] if channels == 1 else img.transpose(2, 0, 1)
+        array.flush()
+        del array
+    with open('{}/index.json'.format(out_path), 'w') as f:
+        json.dump({'names': names, 'channels': channels}, f)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--path', '-p', type=str,
@@ -170,6 +200,11 @@ if __name__ == '__main__':
     parser.add_argument('--resample', type=str, default='bicubic')
     # default save in png format
     parser.add_argument('--lmdb', '-l', action='store_true')
+    # also pack the png folders into npy arrays for the npy datatype
+    parser.add_argument('--npy', action='store_true')
+    # only pack an already prepared split (e.g. after adding noise) found at --out
+    parser.add_argument('--pack', action='store_true')
+    parser.add_argument('--channels', type=int, default=3)
 
     args = parser.parse_args()
 
@@ -177,6 +212,12 @@ if __name__ == '__main__':
     resample = resample_map[args.resample]
     sizes = [int(s.strip()) for s in args.size.split(',')]
 
-    args.out = '{}_{}_{}'.format(args.out, sizes[0], sizes[1])
-    prepare(args.path, args.out, args.n_worker,
-            sizes=sizes, resample=resample, lmdb_save=args.lmdb)
+    if args.pack:
+        pack_npy(args.out, sizes=sizes, channels=args.channels)
+    else:
+        args.out = '{}_{}_{}'.format(args.out, sizes[0], sizes[1])
+        prepare(args.path, args.out, args.n_worker,
+                sizes=sizes, resample=resample, lmdb_save=args.lmdb)
+        if args.npy:
+            assert not args.lmdb, 'npy arrays are packed from the png folders'
+            pack_npy(args.out, sizes=sizes, channels=args.channels)
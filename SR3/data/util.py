@@ -73,11 +73,76 @@ def transform2tensor(img, min_max=(0, 1)):
 # implementation by torchvision, detail in https://github.com/Janspiry/Image-Super-Resolution-via-Iterative-Refinement/issues/14
 totensor = torchvision.transforms.ToTensor()
 hflip = torchvision.transforms.RandomHorizontalFlip()
+
+
+def to_float_tensor(img):
+    # uint8 CHW tensors (npy datasets) are scaled to [0, 1] like ToTensor scales PIL images
+    return img.float().div(255.) if isinstance(img, torch.Tensor) else totensor(img)
+
+
 def transform_augment(img_list, split='val', min_max=(0, 1)):    
-    imgs = [totensor(img) for img in img_list]
+    imgs = [to_float_tensor(img) for img in img_list]
     if split == 'train':
         imgs = torch.stack(imgs, 0)
         imgs = hflip(imgs)
         imgs = torch.unbind(imgs, dim=0)
     ret_img = [img * (min_max[1] - min_max[0]) + min_max[0] for img in imgs]
     return ret_img
+
+
+def motion_blur(img, length, angle, exposure=1):
+    '''
+    libnoise.get_mb_image and the min-max normalization of Apply_Motion_Blur.py on a batch:
+    the B x C x H x W uint8 frames are blurred with one length and angle (degrees) each,
+    as given to that script, filtering in the frequency domain zero padded to twice the size, and returned as uint8.
+    '''
+    n, _, h, w = img.shape
+    # meshuv of the padded size, rows run bottom-up and the upper half of frequencies is negative
+    u = torch.arange(2 * w, dtype=torch.float64)
+    u = torch.where(u > w, u - 2 * w, u)
+    v = torch.arange(2 * h, dtype=torch.float64).flip(0)
+    v = torch.where(v > h, v - 2 * h, v)
+    # get_mb_ab_params
+    theta = torch.deg2rad(torch.as_tensor(angle, dtype=torch.float64)).view(-1, 1, 1)
+    length = torch.as_tensor(length, dtype=torch.float64).view(-1, 1, 1)
+    a = torch.round(length * torch.cos(theta), decimals=5)
+    b = torch.round(length * torch.sin(theta), decimals=5)
+    # get_mb_filter with the [0, 0] second segment used by Apply_Motion_Blur.py
+    s = u.view(1, 1, -1) * a + v.view(1, -1, 1) * b
+    H = exposure / 2 * (torch.sinc(s) * torch.exp(-1j * torch.pi * s) + torch.exp(-2j * torch.pi * s))
+    g = torch.fft.ifft2(H.unsqueeze(1) * torch.fft.fft2(img.double(), s=(2 * h, 2 * w))).real[..., :h, :w]
+    low = g.amin(dim=(1, 2, 3), keepdim=True)
+    high = g.amax(dim=(1, 2, 3), keepdim=True)
+    return ((g - low) / (high - low).clamp_min(1e-12) * 255).to(torch.uint8)
+
+
+class BatchAugment():
+    '''
+    collate_fn of the datasets with batch_augment. It stacks the uint8 CHW frames and augments
+    the whole batch at once: a random horizontal flip per sample (and with rot a vertical flip
+    and a transpose, i.e. the 8 dihedral transforms), shared by the SR/HR/LR images of the
+    sample, and the scaling to min_max.
+    '''
+
+    def __init__(self, split='val', rot=False, min_max=(-1, 1)):
+        self.split = split
+        self.rot = rot
+        self.min_max = min_max
+
+    def __call__(self, samples):
+        batch = torch.utils.data.default_collate(samples)
+        keys = [key for key in ('LR', 'SR', 'HR') if key in batch]
+        for key in keys:
+            batch[key] = batch[key].float().div_(255.) \
+                .mul_(self.min_max[1] - self.min_max[0]).add_(self.min_max[0])
+        if self.split != 'train':
+            return batch
+        n = batch['HR'].shape[0]
+        transforms = [lambda img: img.flip(-1)]
+        if self.rot:
+            transforms += [lambda img: img.flip(-2), lambda img: img.transpose(-1, -2)]
+        for transform in transforms:
+            index = (torch.rand(n) < 0.5).nonzero().flatten()
+            for key in keys:
+                batch[key][index] = transform(batch[key][index])
+        return batch
@@ -0,0 +1,84 @@
+import torch
+import torch.nn as nn
+import model as Model
+import argparse
+import copy
+import logging
+import sys
+import core.logger as Logger
+from collections import OrderedDict
+from model.sr3_modules.onnx_denoiser import export, OnnxDenoiser
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', type=str, default='config/eval_deblurring.json',
+                        help='JSON file for configuration')
+    parser.add_argument('-p', '--phase', type=str, choices=['val'], help='val(generation)', default='val')
+    parser.add_argument('-gpu', '--gpu_ids', type=str, default=None)
+    parser.add_argument('-debug', '-d', action='store_true')
+    parser.add_argument('-enable_wandb', action='store_true')
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='checkpoint to export (without _gen.pth), defaults to path.resume_state')
+    parser.add_argument('-o', '--out', type=str, required=True, help='ONNX file to write')
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('-b', '--batch_size', type=int, default=2,
+                        help='batch size of the parity check, the exported batch dimension is dynamic')
+    parser.add_argument('--steps', type=int, default=5, help='ddim steps of the sampling parity check')
+    parser.add_argument('--tolerance', type=float, default=1e-3,
+                        help='largest absolute difference to the PyTorch path accepted by the parity check')
+    parser.add_argument('--seed', type=int, default=0)
+
+    # parse configs
+    args = parser.parse_args()
+    opt = Logger.parse(args)
+    if args.checkpoint is not None:
+        opt['path']['resume_state'] = args.checkpoint
+    opt['gpu_ids'] = []
+    opt['model']['onnx'] = None
+    # Convert to NoneDict, which return None for missing key.
+    opt = Logger.dict_to_nonedict(opt)
+
+    Logger.setup_logger(None, opt['path']['log'],
+                        'export', level=logging.INFO, screen=True)
+    logger = logging.getLogger('base')
+
+    diffusion = Model.create_model(opt)
+    network = diffusion.netG.module if isinstance(diffusion.netG, nn.DataParallel) else diffusion.netG
+    network.eval()
+    channels = opt['model']['diffusion']['channels']
+    image_size = opt['model']['diffusion']['image_size']
+    export(network.denoise_fn, args.out, image_size, channels, args.opset)
+    logger.info('Exported the denoiser to {}.'.format(args.out))
+
+    # parity of a single denoiser call, at batch 1 and at the check batch size
+    onnx_denoiser = OnnxDenoiser(args.out)
+    torch.manual_seed(args.seed)
+    diffs = OrderedDict()
+    with torch.no_grad():
+        for batch_size in sorted({1, args.batch_size}):
+            x = torch.randn(batch_size, channels * 2, image_size, image_size)
+            noise_level = torch.rand(batch_size, 1)
+            diffs['denoiser b={}'.format(batch_size)] = (
+                network.denoise_fn(x, noise_level) - onnx_denoiser(x, noise_level)).abs().max().item()
+
+    # parity of a whole ddim sampling run
+    onnx_network = copy.deepcopy(network)
+    onnx_network.denoise_fn = onnx_denoiser
+    schedule_opt = OrderedDict(opt['model']['beta_schedule']['val'])
+    schedule_opt.update({'sampler': 'ddim', 'sample_steps': args.steps, 'timesteps': None,
+                         'strength': 1.0, 'early_stop_threshold': 0.})
+    condition = torch.rand(args.batch_size, channels, image_size, image_size) * 2 - 1
+    outputs = []
+    for net in (network, onnx_network):
+        net.set_new_noise_schedule(schedule_opt, torch.device('cpu'))
+        torch.manual_seed(args.seed)
+        outputs.append(net.super_resolution(condition))
+    diffs['ddim {} steps'.format(args.steps)] = (outputs[0] - outputs[1]).abs().max().item()
+
+    for name, diff in diffs.items():
+        logger.info('# {:<16s} # max abs diff: {:.2e}'.format(name, diff))
+    if max(diffs.values()) > args.tolerance:
+        logger.error('ONNX parity check failed, tolerance {:.1e}.'.format(args.tolerance))
+        sys.exit(1)
+    logger.info('ONNX parity check passed.')
@@ -65,37 +65,41 @@ if __name__ == "__main__":
     result_path = '{}'.format(opt['path']['results'])
     os.makedirs(result_path, exist_ok=True)
     for _,  val_data in enumerate(val_loader):
-        idx += 1
         diffusion.feed_data(val_data)
         diffusion.test(continous=True)
         visuals = diffusion.get_current_visuals(need_LR=False)
 
-        hr_img = Metrics.tensor2img(visuals['HR'])  # uint8
-        fake_img = Metrics.tensor2img(visuals['INF'])  # uint8
+        hr_imgs = Metrics.tensor2imgs(visuals['HR'])  # uint8
+        fake_imgs = Metrics.tensor2imgs(visuals['INF'])  # uint8
+        final_imgs = Metrics.tensor2imgs(visuals['SR'][:, -1])  # uint8
 
-        sr_img_mode = 'grid'
-        if sr_img_mode == 'single':
-            # single img series
-            sr_img = visuals['SR']  # uint8
-            sample_num = sr_img.shape[0]
-            for iter in range(0, sample_num):
+        for b in range(len(hr_imgs)):
+            idx += 1
+            hr_img, fake_img = hr_imgs[b], fake_imgs[b]
+
+            sr_img_mode = 'grid'
+            if sr_img_mode == 'single':
+                # single img series
+                sr_img = visuals['SR'][b]  # uint8
+                sample_num = sr_img.shape[0]
+                for iter in range(0, sample_num):
+                    Metrics.save_img(
+                        Metrics.tensor2img(sr_img[iter]), '{}/{}_{}_sr_{}.png'.format(result_path, current_step, idx, iter))
+            else:
+                # grid img
+                sr_img = Metrics.tensor2img(visuals['SR'][b])  # uint8
+                Metrics.save_img(
+                    sr_img, '{}/{}_{}_sr_process.png'.format(result_path, current_step, idx))
                 Metrics.save_img(
-                    Metrics.tensor2img(sr_img[iter]), '{}/{}_{}_sr_{}.png'.format(result_path, current_step, idx, iter))
-        else:
-            # grid img
-            sr_img = Metrics.tensor2img(visuals['SR'])  # uint8
+                    final_imgs[b], '{}/{}_{}_sr.png'.format(result_path, current_step, idx))
+
             Metrics.save_img(
-                sr_img, '{}/{}_{}_sr_process.png'.format(result_path, current_step, idx))
+                hr_img, '{}/{}_{}_hr.png'.format(result_path, current_step, idx))
             Metrics.save_img(
-                Metrics.tensor2img(visuals['SR'][-1]), '{}/{}_{}_sr.png'.format(result_path, current_step, idx))
-
-        Metrics.save_img(
-            hr_img, '{}/{}_{}_hr.png'.format(result_path, current_step, idx))
-        Metrics.save_img(
-            fake_img, '{}/{}_{}_inf.png'.format(result_path, current_step, idx))
+                fake_img, '{}/{}_{}_inf.png'.format(result_path, current_step, idx))
 
-        if wandb_logger and opt['log_infer']:
-            wandb_logger.log_eval_data(fake_img, Metrics.tensor2img(visuals['SR'][-1]), hr_img)
+            if wandb_logger and opt['log_infer']:
+                wandb_logger.log_eval_data(fake_img, final_imgs[b], hr_img)
 
     if wandb_logger and opt['log_infer']:
         wandb_logger.log_eval_table(commit=True)
@@ -6,7 +6,9 @@ import torch.nn as nn
 class BaseModel():
     def __init__(self, opt):
         self.opt = opt
-        self.device = torch.device('cuda') # Change if gpu is available
+        # cpu when no gpu is configured or available, e.g. on cpu-only inference nodes
+        self.device = torch.device(
+            'cuda' if opt['gpu_ids'] and torch.cuda.is_available() else 'cpu')
         self.begin_step = 0
         self.begin_epoch = 0
 
@@ -112,18 +112,16 @@ class SelfAttention(nn.Module):
         head_dim = channel // n_head
 
         norm = self.norm(input)
-        qkv = self.qkv(norm).view(batch, n_head, head_dim * 3, height, width)
-        query, key, value = qkv.chunk(3, dim=2)  # bhdyx
-
-        attn = torch.einsum(
-            "bnchw, bncyx -> bnhwyx", query, key
-        ).contiguous() / math.sqrt(channel)
-        attn = attn.view(batch, n_head, height, width, -1)
-        attn = torch.softmax(attn, -1)
-        attn = attn.view(batch, n_head, height, width, height, width)
-
-        out = torch.einsum("bnhwyx, bncyx -> bnchw", attn, value).contiguous()
-        out = self.out(out.view(batch, channel, height, width))
+        # tokens last-dim contiguous so scaled_dot_product_attention can use a fused
+        # kernel instead of building the (hw)^2 score tensor
+        qkv = self.qkv(norm).view(batch, n_head, head_dim * 3, height * width)
+        qkv = qkv.transpose(-1, -2).contiguous()
+        query, key, value = qkv.chunk(3, dim=-1)  # bn(hw)d
+
+        out = F.scaled_dot_product_attention(
+            query, key, value, scale=1. / math.sqrt(channel))  # bn(hw)d
+        out = out.transpose(-1, -2).reshape(batch, channel, height, width)
+        out = self.out(out)
 
         return out + input
 
@@ -1,11 +1,15 @@
 import logging
 from collections import OrderedDict
 
+import contextlib
+import copy
+import inspect
 import torch
 import torch.nn as nn
 import os
 import model.networks as networks
 from .base_model import BaseModel
+from .sr3_modules.diffusion import TrajectoryRecorder
 logger = logging.getLogger('base')
 
 
@@ -15,12 +19,13 @@ class DDPM(BaseModel):
         # define network and load pretrained models
         self.netG = self.set_device(networks.define_G(opt))
         self.schedule_phase = None
+        self.continous = False
 
         # set loss and load resume state
         self.set_loss()
         self.set_new_noise_schedule(
             opt['model']['beta_schedule']['train'], schedule_phase='train')
-        if self.opt['phase'] == 'train':
+        if self.opt['phase'] in ('train', 'distill'):
             self.netG.train()
             # find the parameters to optimize
             if opt['model']['finetune_norm']:
@@ -39,36 +44,161 @@ class DDPM(BaseModel):
             self.optG = torch.optim.Adam(
                 optim_params, lr=opt['train']["optimizer"]["lr"])
             self.log_dict = OrderedDict()
+            self.set_train_precision(opt['train']['precision'])
+            # micro-batches whose gradients are summed into one optimizer step
+            self.accumulate_steps = opt['train']['accumulate_steps'] or 1
+            self.micro_step = 0
+            if self.accumulate_steps > 1:
+                logger.info('Accumulating gradients over {:d} micro-batches (effective batch size {:d}).'.format(
+                    self.accumulate_steps, self.accumulate_steps * opt['datasets']['train']['batch_size']))
         self.load_network()
+        if self.opt['phase'] == 'distill':
+            self.init_distillation()
+        network = self.netG.module if isinstance(self.netG, nn.DataParallel) else self.netG
+        inference_opt = self.opt['model']['inference']
+        if self.opt['phase'] == 'val' and self.opt['model']['onnx']:
+            # exported denoiser run by onnxruntime, the diffusion arithmetic stays in torch
+            from .sr3_modules.onnx_denoiser import OnnxDenoiser
+            network.denoise_fn = OnnxDenoiser(self.opt['model']['onnx'])
+            logger.info('Sampling with the ONNX denoiser [{:s}].'.format(self.opt['model']['onnx']))
+        elif self.opt['phase'] == 'val' and inference_opt and hasattr(network, 'set_inference'):
+            # the ddpm model always samples in fp32 with the contiguous layout
+            network.set_inference(inference_opt['precision'], inference_opt['channels_last'])
+            logger.info('Sampling in {} ({}).'.format(
+                inference_opt['precision'] or 'fp32',
+                'channels_last' if inference_opt['channels_last'] else 'contiguous'))
+        if self.opt['model']['compile'] and not self.opt['model']['onnx']:
+            # compiled after the teacher copy, which keeps sampling eagerly
+            network.compile_denoiser()
         self.print_network()
 
     def feed_data(self, data):
         self.data = self.set_device(data)
 
+    def set_train_precision(self, precision):
+        '''
+        Mixed precision training: the forward pass runs under autocast while the weights,
+        the loss reduction and the Adam step stay fp32. fp16 needs loss scaling, which
+        is only available on cuda, bf16 has the fp32 exponent range and needs none.
+        '''
+        precision = precision or 'fp32'
+        if precision == 'fp16' and self.device.type != 'cuda':
+            logger.warning('fp16 training needs cuda, training in bf16.')
+            precision = 'bf16'
+        dtypes = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+        self.amp_dtype = dtypes[precision]
+        grad_scaler = torch.amp.GradScaler if hasattr(torch.amp, 'GradScaler') else torch.cuda.amp.GradScaler
+        self.scaler = grad_scaler(enabled=precision == 'fp16')
+        if precision != 'fp32':
+            logger.info('Training in mixed precision ({}).'.format(precision))
+
+    def init_distillation(self):
+        # the loaded checkpoint becomes a frozen teacher, the student starts as a copy of it
+        assert self.opt['path']['resume_state'], 'distillation needs a trained checkpoint as teacher'
+        distill_opt = self.opt['train']['distill']
+        network = self.netG
+        if isinstance(self.netG, nn.DataParallel):
+            network = network.module
+        if self.sample_schedule is not None:
+            # resuming from a student, keep halving its own steps
+            self.distill_timesteps = list(self.sample_schedule['timesteps'])
+        else:
+            self.distill_timesteps = network.sample_timesteps(
+                distill_opt['start_steps'], distill_opt['timestep_spacing'] or 'uniform')
+        self.teacher = copy.deepcopy(network)
+        self.teacher.ddim_eta = 0.
+        self.teacher.eval()
+        for v in self.teacher.parameters():
+            v.requires_grad = False
+        logger.info('Distilling {:d} teacher steps into {:d} student steps.'.format(
+            len(self.distill_timesteps), len(self.distill_timesteps[::2])))
+
+    def next_distill_round(self):
+        '''the trained student becomes the teacher of the next halving, False once the target is reached'''
+        if len(self.distill_timesteps[::2]) <= self.opt['train']['distill']['target_steps']:
+            return False
+        network = self.netG
+        if isinstance(self.netG, nn.DataParallel):
+            network = network.module
+        self.teacher.load_state_dict(network.state_dict())
+        self.distill_timesteps = self.distill_timesteps[::2]
+        self.optG = torch.optim.Adam(
+            [v for v in self.netG.parameters() if v.requires_grad], lr=self.opt['train']["optimizer"]["lr"])
+        logger.info('Distilling {:d} teacher steps into {:d} student steps.'.format(
+            len(self.distill_timesteps), len(self.distill_timesteps[::2])))
+        return True
+
     def optimize_parameters(self):
-        self.optG.zero_grad()
-        l_pix = self.netG(self.data)
+        '''one micro-batch of train.accumulate_steps, returns True when it completed an optimizer step'''
+        if self.micro_step == 0:
+            self.optG.zero_grad()
+            self.accumulated_loss = 0.
+        self.micro_step += 1
+        last = self.micro_step == self.accumulate_steps
+        # distributed wrappers only need to reduce the gradients of the last micro-batch
+        no_sync = getattr(self.netG, 'no_sync', None)
+        with contextlib.nullcontext() if last or no_sync is None else no_sync():
+            self.backward_micro_batch()
+        if not last:
+            return False
+        self.micro_step = 0
+        self.scaler.step(self.optG)
+        self.scaler.update()
+
+        # set log
+        self.log_dict['l_pix'] = self.accumulated_loss.item() / self.accumulate_steps
+        return True
+
+    def backward_micro_batch(self):
+        with torch.autocast(self.device.type, dtype=self.amp_dtype, enabled=self.amp_dtype is not None):
+            if self.opt['phase'] == 'distill':
+                network = self.netG
+                if isinstance(self.netG, nn.DataParallel):
+                    network = network.module
+                l_pix = network.distill_losses(self.data, self.teacher, self.distill_timesteps)
+            else:
+                l_pix = self.netG(self.data)
         # need to average in multi-gpu
         b, c, h, w = self.data['HR'].shape
         l_pix = l_pix.sum()/int(b*c*h*w)
-        l_pix.backward()
-        self.optG.step()
-
-        # set log
-        self.log_dict['l_pix'] = l_pix.item()
+        # the scaler is a no-op unless training in fp16
+        self.scaler.scale(l_pix / self.accumulate_steps).backward()
+        self.accumulated_loss += l_pix.detach()
 
     def test(self, continous=False):
+        self.continous = continous
+        network = self.netG.module if isinstance(self.netG, nn.DataParallel) else self.netG
+        kwargs = {}
+        # the ddpm model keeps its own trajectory and takes no recorder
+        if continous and self.opt['model']['trajectory'] and \
+                'recorder' in inspect.signature(network.super_resolution).parameters:
+            kwargs['recorder'] = self.trajectory_recorder()
+        if 'Index' in self.data and 'seeds' in inspect.signature(network.super_resolution).parameters:
+            # the noise of every image is seeded from its dataset index, so an image gives
+            # the same result in any batch, torch.manual_seed still changes all of them
+            kwargs['seeds'] = [(torch.initial_seed() + index) % 2 ** 63 for index in self.data['Index'].tolist()]
         self.netG.eval()
         with torch.no_grad():
             if isinstance(self.netG, nn.DataParallel):
                 self.SR = self.netG.module.super_resolution(
-                    self.data['SR'], continous)
+                    self.data['SR'], continous, **kwargs)
             else:
                 self.SR = self.netG.super_resolution(
-                    self.data['SR'], continous)
+                    self.data['SR'], continous, **kwargs)
+        # the ddpm model has no early stopping
+        if getattr(network, 'early_stop_threshold', 0) > 0:
+            logger.info('Sampling steps per image: {}'.format(network.sample_steps_used))
         self.netG.train()
 
+    def trajectory_recorder(self):
+        traj_opt = self.opt['model']['trajectory']
+        dtypes = {'float32': torch.float32, 'float16': torch.float16, 'uint8': torch.uint8}
+        return TrajectoryRecorder(
+            dtype=dtypes[traj_opt['dtype'] or 'float32'], timesteps=traj_opt['timesteps'])
+
     def sample(self, batch_size=1, continous=False):
+        self.continous = continous
+        self.sample_batch_size = batch_size
         self.netG.eval()
         with torch.no_grad():
             if isinstance(self.netG, nn.DataParallel):
@@ -92,15 +222,27 @@ class DDPM(BaseModel):
             else:
                 self.netG.set_new_noise_schedule(schedule_opt, self.device)
 
+    def get_sample_steps(self):
+        # denoiser calls spent on each image of the last test batch
+        network = self.netG
+        if isinstance(self.netG, nn.DataParallel):
+            network = network.module
+        if not hasattr(network, 'sample_steps_used'):
+            # the ddpm model always runs its whole chain
+            return [network.num_timesteps] * self.data['SR'].shape[0]
+        return list(network.sample_steps_used)
+
     def get_current_log(self):
         return self.log_dict
 
     def get_current_visuals(self, need_LR=True, sample=False):
         out_dict = OrderedDict()
         if sample:
-            out_dict['SAM'] = self.SR.detach().float().cpu()
+            out_dict['SAM'] = self.split_trajectory(
+                self.SR.detach().float().cpu(), self.sample_batch_size)
         else:
-            out_dict['SR'] = self.SR.detach().float().cpu()
+            out_dict['SR'] = self.split_trajectory(
+                self.SR.detach().float().cpu(), self.data['SR'].shape[0])
             out_dict['INF'] = self.data['SR'].detach().float().cpu()
             out_dict['HR'] = self.data['HR'].detach().float().cpu()
             if need_LR and 'LR' in self.data:
@@ -109,6 +251,13 @@ class DDPM(BaseModel):
                 out_dict['LR'] = out_dict['INF']
         return out_dict
 
+    def split_trajectory(self, img, batch_size=1):
+        # continous sampling returns the batch stacked once per saved step,
+        # regroup it as [batch, step, C, H, W] so each image keeps its own process
+        if self.continous:
+            return img.view(-1, batch_size, *img.shape[1:]).transpose(0, 1)
+        return img
+
     def print_network(self):
         s, n = self.get_network_description(self.netG)
         if isinstance(self.netG, nn.DataParallel):
@@ -138,6 +287,12 @@ class DDPM(BaseModel):
         opt_state = {'epoch': epoch, 'iter': iter_step,
                      'scheduler': None, 'optimizer': None}
         opt_state['optimizer'] = self.optG.state_dict()
+        # loss scale and growth tracker, empty unless training in fp16
+        opt_state['scaler'] = self.scaler.state_dict()
+        if self.opt['phase'] == 'distill':
+            # sampler the student was distilled for, picked up by load_network
+            opt_state['sample_schedule'] = {
+                'sampler': 'ddim', 'ddim_eta': 0., 'timesteps': self.distill_timesteps[::2]}
         torch.save(opt_state, opt_path)
 
         logger.info(
@@ -145,6 +300,7 @@ class DDPM(BaseModel):
 
     def load_network(self):
         load_path = self.opt['path']['resume_state']
+        self.sample_schedule = None
         if load_path is not None:
             logger.info(
                 'Loading pretrained model for G [{:s}] ...'.format(load_path))
@@ -154,13 +310,37 @@ class DDPM(BaseModel):
             network = self.netG
             if isinstance(self.netG, nn.DataParallel):
                 network = network.module
-            network.load_state_dict(torch.load(
-                gen_path), strict=(not self.opt['model']['finetune_norm']))
+            state_dict = torch.load(gen_path)
+            quantization = state_dict.pop('quantization', None)
+            if quantization is not None:
+                # int8 checkpoint written by quantize.py, rebuild its quantized modules first
+                from .sr3_modules.quantize import build_int8
+                assert self.device.type == 'cpu', 'int8 checkpoints only run on cpu'
+                build_int8(network.denoise_fn, quantization['backend'])
+                logger.info('Checkpoint is quantized to int8 ({}).'.format(quantization['backend']))
+            network.load_state_dict(state_dict, strict=(not self.opt['model']['finetune_norm']))
             # network.load_state_dict(torch.load(
             #     gen_path), strict=False)
+            if self.opt['phase'] != 'train' and os.path.exists(opt_path):
+                # distilled students are sampled with the steps they were trained for
+                self.sample_schedule = torch.load(opt_path, map_location='cpu').get('sample_schedule')
+                if self.sample_schedule is not None:
+                    logger.info('Checkpoint was distilled for {:d} steps.'.format(
+                        len(self.sample_schedule['timesteps'])))
+                    self.opt['model']['beta_schedule']['val'].update(self.sample_schedule)
             if self.opt['phase'] == 'train':
                 # optimizer
                 opt = torch.load(opt_path)
-                self.optG.load_state_dict(opt['optimizer'])
+                if opt['optimizer'] is not None:
+                    # converted checkpoints start with a fresh optimizer
+                    self.optG.load_state_dict(opt['optimizer'])
+                if opt.get('scaler') and self.scaler.is_enabled():
+                    self.scaler.load_state_dict(opt['scaler'])
+                self.begin_step = opt['iter']
+                self.begin_epoch = opt['epoch']
+            elif self.opt['phase'] == 'distill' and os.path.exists(opt_path):
+                # every round starts with a fresh optimizer, only the numbering of the saved
+                # students continues, so a resumed round does not overwrite earlier ones
+                opt = torch.load(opt_path, map_location='cpu')
                 self.begin_step = opt['iter']
                 self.begin_epoch = opt['epoch']
@@ -88,6 +88,12 @@ def define_G(opt):
         from .sr3_modules import diffusion, unet
     if ('norm_groups' not in model_opt['unet']) or model_opt['unet']['norm_groups'] is None:
         model_opt['unet']['norm_groups']=32
+    channels = model_opt['diffusion']['channels']
+    assert model_opt['unet']['out_channel'] == channels and \
+        model_opt['unet']['in_channel'] == channels * (2 if model_opt['diffusion']['conditional'] else 1), \
+        'unet in_channel/out_channel do not match {} image channels'.format(channels)
+    # activation checkpointing is only implemented by the sr3 UNet
+    unet_kwargs = {'use_checkpoint': True} if model_opt['unet']['use_checkpoint'] else {}
     model = unet.UNet(
         in_channel=model_opt['unet']['in_channel'],
         out_channel=model_opt['unet']['out_channel'],
@@ -97,7 +103,8 @@ def define_G(opt):
         attn_res=model_opt['unet']['attn_res'],
         res_blocks=model_opt['unet']['res_blocks'],
         dropout=model_opt['unet']['dropout'],
-        image_size=model_opt['diffusion']['image_size']
+        image_size=model_opt['diffusion']['image_size'],
+        **unet_kwargs
     )
     netG = diffusion.GaussianDiffusion(
         model,
@@ -5,7 +5,9 @@ import torch.nn.functional as F
 from inspect import isfunction
 from functools import partial
 import numpy as np
+import logging
 from tqdm import tqdm
+logger = logging.getLogger('base')
 
 
 def _warmup_beta(linear_start, linear_end, n_timestep, warmup_frac):
@@ -49,6 +51,60 @@ def make_beta_schedule(schedule, n_timestep, linear_start=1e-4, linear_end=2e-2,
     return betas
 
 
+class TrajectoryRecorder():
+    '''
+    Keeps the intermediate frames of a sampling loop.
+    Frames are written into a buffer allocated once for the whole trajectory, or
+    handed to sink(t, frame) as they are produced when a sink is given.
+    dtype: torch.float32, torch.float16 or torch.uint8 ([-1, 1] quantized to [0, 255])
+    timesteps: timesteps to keep, None keeps the default selection of the loop
+    '''
+
+    def __init__(self, dtype=torch.float32, timesteps=None, sink=None):
+        self.dtype = dtype
+        self.timesteps = timesteps
+        self.sink = sink
+        self.buffer = None
+
+    def begin(self, first, timesteps, sample_inter=1):
+        # first is the condition (or the starting noise), stored before any step
+        if self.timesteps is None:
+            # every sample_inter-th step counting back from the last one
+            self.keep = set(timesteps[::-1][::sample_inter])
+        else:
+            # the last frame is the result read by sr.py and infer.py, so it is always kept
+            self.keep = (set(timesteps) & set(self.timesteps)) | {timesteps[-1]}
+        self.batch_size = first.shape[0]
+        self.slot = 0
+        if self.sink is None:
+            self.buffer = torch.empty(
+                ((len(self.keep) + 1) * self.batch_size, *first.shape[1:]),
+                dtype=self.dtype, device=first.device)
+        self.add(None, first)
+
+    def record(self, t, img):
+        if t in self.keep:
+            self.add(t, img)
+
+    def add(self, t, img):
+        if self.dtype == torch.uint8:
+            frame = ((img.clamp(-1., 1.) + 1.) * 127.5).round().to(torch.uint8)
+        else:
+            frame = img.to(self.dtype)
+        if self.sink is not None:
+            self.sink(t, frame)
+        else:
+            self.buffer[self.slot * self.batch_size:(self.slot + 1) * self.batch_size] = frame
+        self.slot += 1
+
+    def frames(self):
+        if self.buffer is None:
+            return None
+        if self.dtype == torch.uint8:
+            return self.buffer.float() / 127.5 - 1.
+        return self.buffer
+
+
 # gaussian diffusion trainer class
 
 def exists(x):
@@ -77,6 +133,14 @@ class GaussianDiffusion(nn.Module):
         self.denoise_fn = denoise_fn
         self.loss_type = loss_type
         self.conditional = conditional
+        self.condition_cached = False
+        self.compiled_denoise_fn = None
+        # set by sample_loop when the steps of the current loop run the compiled graph
+        self.use_compiled = False
+        # one generator per image of the current sampling loop, see sample_noise
+        self.generators = None
+        self.autocast_dtype = None
+        self.channels_last = False
         if schedule_opt is not None:
             pass
             # self.set_new_noise_schedule(schedule_opt)
@@ -138,6 +202,31 @@ class GaussianDiffusion(nn.Module):
         self.register_buffer('posterior_mean_coef2', to_torch(
             (1. - alphas_cumprod_prev) * np.sqrt(alphas) / (1. - alphas_cumprod)))
 
+        # noise level embeddings cached in the denoiser for the sampled timesteps
+        self.noise_cache_timesteps = None
+        if hasattr(self.denoise_fn, 'clear_noise_cache'):
+            self.denoise_fn.clear_noise_cache()
+
+        # sampler used by p_sample_loop, 'ddpm' walks every timestep while 'ddim' and
+        # 'dpm_solver' walk sample_steps timesteps spaced uniformly in time or in log-SNR
+        self.sampler = schedule_opt.get('sampler') or 'ddpm'
+        self.sample_steps = schedule_opt.get('sample_steps') or self.num_timesteps
+        self.timestep_spacing = schedule_opt.get('timestep_spacing') or 'uniform'
+        # explicit list of timesteps, overrides sample_steps and timestep_spacing
+        self.timesteps = schedule_opt.get('timesteps')
+        self.ddim_eta = schedule_opt.get('ddim_eta') or 0.
+        self.solver_order = schedule_opt.get('solver_order') or 2
+        # fraction of the reverse process run in conditional sampling, < 1 starts
+        # from a noised copy of the condition instead of pure noise
+        self.strength = schedule_opt.get('strength') or 1.
+        # an image stops early, jumping to its x_0 estimate, once that estimate changes by less
+        # than this (mean absolute change per unit of noise level) between steps, 0 disables it
+        self.early_stop_threshold = schedule_opt.get('early_stop_threshold') or 0.
+        # the deep levels of the denoiser run every deep_cache_interval steps and their features
+        # are reused in between, only the outer deep_cache_levels run every step, <= 1 disables it
+        self.deep_cache_interval = schedule_opt.get('deep_cache_interval') or 1
+        self.deep_cache_levels = schedule_opt.get('deep_cache_levels') or 1
+
     def predict_start_from_noise(self, x_t, t, noise):
         return self.sqrt_recip_alphas_cumprod[t] * x_t - \
             self.sqrt_recipm1_alphas_cumprod[t] * noise
@@ -148,19 +237,97 @@ class GaussianDiffusion(nn.Module):
         posterior_log_variance_clipped = self.posterior_log_variance_clipped[t]
         return posterior_mean, posterior_log_variance_clipped
 
-    def p_mean_variance(self, x, t, clip_denoised: bool, condition_x=None):
+    def build_noise_cache(self, timesteps):
+        # the noise level of a timestep is fixed by the schedule, so its embedding and
+        # every affine projection in the denoiser are computed once and looked up per step
+        if not hasattr(self.denoise_fn, 'cache_noise_levels'):
+            return
+        if self.noise_cache_timesteps is not None and self.noise_cache_timesteps == tuple(timesteps):
+            return
+        noise_levels = torch.tensor(
+            self.sqrt_alphas_cumprod_prev[np.array(timesteps) + 1], dtype=torch.float32, device=self.betas.device)
+        self.denoise_fn.cache_noise_levels(noise_levels)
+        self.noise_cache_timesteps = tuple(timesteps)
+        self.noise_cache_index = {t: i for i, t in enumerate(timesteps)}
+
+    def set_inference(self, precision='fp32', channels_last=False):
+        '''
+        Precision and memory layout of the denoiser at sampling time. 'bf16' runs the
+        denoiser under autocast while the schedule buffers, q_posterior and the sampler
+        updates stay fp32.
+        '''
+        dtypes = {'fp32': None, 'bf16': torch.bfloat16}
+        self.autocast_dtype = dtypes[precision or 'fp32']
+        self.channels_last = channels_last
+        self.denoise_fn.to(memory_format=torch.channels_last if channels_last else torch.contiguous_format)
+
+    def compile_denoiser(self, mode=None):
+        '''
+        Opt-in torch.compile of the denoiser used by the sampling loops. The compiled
+        graph is specialized to the batch shape and fuses the GroupNorm/Swish/Conv
+        sequences, sampling stays eager when torch.compile is unavailable or fails.
+        It runs UNet.forward_cached, so the noise embedding and condition conv caches
+        are passed to it as tensors.
+        '''
+        if not hasattr(torch, 'compile') or not hasattr(self.denoise_fn, 'forward_cached'):
+            logger.warning('torch.compile is not available, sampling with the eager denoiser.')
+            self.compiled_denoise_fn = None
+            return
+        # a compiled function rather than module, so it is not registered in the state dict
+        self.compiled_denoise_fn = torch.compile(self.denoise_fn.forward_cached, mode=mode, dynamic=False)
+
+    def compiled_noise(self, x, t, condition_x=None):
+        # the row of the noise cache built on the device for this loop, a tensor input
+        # rather than the index, which the graph would specialize on
+        noise_row = self.denoise_fn.noise_cache[self.noise_cache_index[t]]
+        if self.condition_cached:
+            args = (x, noise_row, self.denoise_fn.condition_cache, self.denoise_fn.condition_cache_weight)
+        else:
+            args = (torch.cat([condition_x, x], dim=1) if condition_x is not None else x, noise_row)
+        try:
+            return self.compiled_denoise_fn(*args)
+        except torch._dynamo.exc.TorchDynamoException as e:
+            # only compilation failures fall back, runtime errors such as OOM are raised
+            logger.warning('torch.compile failed, sampling with the eager denoiser: {}'.format(e))
+            self.compiled_denoise_fn = None
+            self.use_compiled = False
+            return self.run_denoiser(x, t, condition_x)
+
+    def predict_noise(self, x, t, condition_x=None):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+            if condition_x is not None:
+                condition_x = condition_x.contiguous(memory_format=torch.channels_last)
+        if self.autocast_dtype is not None and not torch.is_grad_enabled():
+            with torch.autocast(x.device.type, dtype=self.autocast_dtype):
+                noise = self.run_denoiser(x, t, condition_x)
+            return noise.float()
+        return self.run_denoiser(x, t, condition_x)
+
+    def run_denoiser(self, x, t, condition_x=None):
         batch_size = x.shape[0]
-        noise_level = torch.FloatTensor(
-            [self.sqrt_alphas_cumprod_prev[t+1]]).repeat(batch_size, 1).to(x.device)
-        if condition_x is not None:
-            x_recon = self.predict_start_from_noise(
-                x, t=t, noise=self.denoise_fn(torch.cat([condition_x, x], dim=1), noise_level))
+        if self.use_compiled and not torch.is_grad_enabled() and t in self.noise_cache_index:
+            return self.compiled_noise(x, t, condition_x)
+        # the cached embeddings are built without grad from the weights at caching time,
+        # so training through run_denoiser (distill_losses) computes them afresh
+        if self.noise_cache_timesteps is not None and t in self.noise_cache_index and \
+                not torch.is_grad_enabled():
+            noise_level = self.noise_cache_index[t]
         else:
-            x_recon = self.predict_start_from_noise(
-                x, t=t, noise=self.denoise_fn(x, noise_level))
+            noise_level = torch.FloatTensor(
+                [self.sqrt_alphas_cumprod_prev[t+1]]).repeat(batch_size, 1).to(x.device)
+        if condition_x is not None and not self.condition_cached:
+            return self.denoise_fn(torch.cat([condition_x, x], dim=1), noise_level)
+        else:
+            return self.denoise_fn(x, noise_level)
+
+    def p_mean_variance(self, x, t, clip_denoised: bool, condition_x=None):
+        x_recon = self.predict_start_from_noise(
+            x, t=t, noise=self.predict_noise(x, t, condition_x=condition_x))
 
         if clip_denoised:
             x_recon.clamp_(-1., 1.)
+        self.x_recon = x_recon
 
         model_mean, posterior_log_variance = self.q_posterior(
             x_start=x_recon, x_t=x, t=t)
@@ -170,44 +337,245 @@ class GaussianDiffusion(nn.Module):
     def p_sample(self, x, t, clip_denoised=True, condition_x=None):
         model_mean, model_log_variance = self.p_mean_variance(
             x=x, t=t, clip_denoised=clip_denoised, condition_x=condition_x)
-        noise = torch.randn_like(x) if t > 0 else torch.zeros_like(x)
+        noise = self.sample_noise(x) if t > 0 else torch.zeros_like(x)
         return model_mean + noise * (0.5 * model_log_variance).exp()
 
+    def sample_timesteps(self, sample_steps=None, timestep_spacing=None):
+        # subset of the training timesteps visited by the strided samplers, from T-1 down to 0
+        if sample_steps is None and self.timesteps:
+            return sorted(set(int(t) for t in self.timesteps), reverse=True)
+        sample_steps = max(1, min(default(sample_steps, self.sample_steps), self.num_timesteps))
+        timestep_spacing = default(timestep_spacing, self.timestep_spacing)
+        if timestep_spacing == 'uniform':
+            timesteps = np.linspace(
+                0, self.num_timesteps - 1, sample_steps).round().astype(np.int64)
+        elif timestep_spacing == 'logsnr':
+            alphas_cumprod = self.alphas_cumprod.cpu().numpy().astype(np.float64)
+            log_snr = np.log(alphas_cumprod / (1. - alphas_cumprod))
+            # log_snr decreases with t, pick the timesteps closest to evenly spaced values
+            targets = np.linspace(log_snr[0], log_snr[-1], sample_steps)
+            timesteps = np.abs(log_snr[None, :] - targets[:, None]).argmin(axis=1)
+        else:
+            raise NotImplementedError(timestep_spacing)
+        return np.unique(timesteps)[::-1].tolist()
+
     @torch.no_grad()
-    def p_sample_loop(self, x_in, continous=False):
+    def ddim_sample(self, x, t, t_prev, clip_denoised=True, condition_x=None):
+        noise = self.predict_noise(x, t, condition_x=condition_x)
+        x_recon = self.predict_start_from_noise(x, t=t, noise=noise)
+        if clip_denoised:
+            x_recon.clamp_(-1., 1.)
+            # keep the noise estimate consistent with the clipped x_0
+            noise = (self.sqrt_recip_alphas_cumprod[t] * x - x_recon) / \
+                self.sqrt_recipm1_alphas_cumprod[t]
+        self.x_recon = x_recon
+
+        alpha = self.alphas_cumprod[t]
+        alpha_prev = self.alphas_cumprod[t_prev] if t_prev >= 0 else torch.ones_like(alpha)
+        sigma = self.ddim_eta * \
+            ((1. - alpha_prev) / (1. - alpha) * (1. - alpha / alpha_prev)).sqrt()
+        img = alpha_prev.sqrt() * x_recon + \
+            (1. - alpha_prev - sigma ** 2).clamp(min=0.).sqrt() * noise
+        if self.ddim_eta > 0 and t_prev >= 0:
+            img = img + sigma * self.sample_noise(x)
+        return img
+
+    def log_snr(self, t):
+        return torch.log(self.sqrt_alphas_cumprod[t] / self.sqrt_one_minus_alphas_cumprod[t])
+
+    def dpm_solver_step_fn(self, order=2):
+        '''
+        Multistep DPM-Solver++ (data prediction) step. The returned function keeps the
+        previous x_0 estimate, so a new one is needed for every sampling loop.
+        '''
+        if order not in (1, 2):
+            raise NotImplementedError('dpm_solver order {}'.format(order))
+        state = {'x_recon': None, 'h': None}
+
+        @torch.no_grad()
+        def dpm_solver_sample(x, t, t_prev, clip_denoised=True, condition_x=None):
+            x_recon = self.predict_start_from_noise(
+                x, t=t, noise=self.predict_noise(x, t, condition_x=condition_x))
+            if clip_denoised:
+                x_recon.clamp_(-1., 1.)
+            self.x_recon = x_recon
+            if t_prev < 0:
+                # sigma is 0 at the end of the chain, the solution is the x_0 estimate
+                return x_recon
+
+            h = self.log_snr(t_prev) - self.log_snr(t)
+            # the step into t=0 covers a very large log-SNR range, extrapolating
+            # the previous estimate over it is unstable so it stays first order
+            if order == 2 and state['x_recon'] is not None and t_prev > 0:
+                r = state['h'] / h
+                d = (1. + 0.5 / r) * x_recon - (0.5 / r) * state['x_recon']
+            else:
+                d = x_recon
+            state['x_recon'], state['h'] = x_recon, h
+
+            return (self.sqrt_one_minus_alphas_cumprod[t_prev] / self.sqrt_one_minus_alphas_cumprod[t]) * x - \
+                self.sqrt_alphas_cumprod[t_prev] * torch.expm1(-h) * d
+
+        def select(index):
+            # follow the images still being sampled when the batch shrinks
+            if state['x_recon'] is not None:
+                state['x_recon'] = state['x_recon'][index]
+
+        dpm_solver_sample.select = select
+        return dpm_solver_sample
+
+    def get_sampler(self):
+        '''timesteps, step function and progress label of the configured sampler'''
+        if self.sampler == 'ddpm':
+            return list(reversed(range(0, self.num_timesteps))), \
+                lambda x, t, t_prev, condition_x: self.p_sample(x, t, condition_x=condition_x), \
+                'sampling loop time step'
+        elif self.sampler == 'ddim':
+            return self.sample_timesteps(), self.ddim_sample, 'ddim sampling loop time step'
+        elif self.sampler == 'dpm_solver':
+            return self.sample_timesteps(), self.dpm_solver_step_fn(self.solver_order), \
+                'dpm-solver++ sampling loop time step'
+        else:
+            raise NotImplementedError(self.sampler)
+
+    def sample_noise(self, x):
+        '''
+        Standard normal noise like x. When the loop was given seeds every image draws from
+        its own generator, so its samples do not depend on the batch it is in.
+        '''
+        if self.generators is None:
+            return torch.randn_like(x)
+        return torch.stack([torch.randn(x.shape[1:], generator=generator, device=x.device, dtype=x.dtype)
+                            for generator in self.generators])
+
+    def start_timestep(self, strength):
+        return max(0, min(self.num_timesteps, int(round(strength * self.num_timesteps))) - 1)
+
+    @torch.no_grad()
+    def sample_loop(self, x_in, timesteps, step_fn, continous=False, recorder=None, desc='sampling loop time step',
+                    start_timestep=None, seeds=None):
         device = self.betas.device
-        sample_inter = (1 | (self.num_timesteps//10))
+        self.generators = None if seeds is None else \
+            [torch.Generator(device=device).manual_seed(int(seed)) for seed in seeds]
+        # timestep at which the last loop noised the condition, None when it started from pure noise
+        self.condition_start_timestep = None
         if not self.conditional:
-            shape = x_in
-            img = torch.randn(shape, device=device)
-            ret_img = img
-            for i in tqdm(reversed(range(0, self.num_timesteps)), desc='sampling loop time step', total=self.num_timesteps):
-                img = self.p_sample(img, i)
-                if i % sample_inter == 0:
-                    ret_img = torch.cat([ret_img, img], dim=0)
+            condition_x = None
+            img = torch.randn(x_in, device=device)
+            first = img
         else:
-            x = x_in
-            shape = x.shape
-            img = torch.randn(shape, device=device)
-            ret_img = x
-            for i in tqdm(reversed(range(0, self.num_timesteps)), desc='sampling loop time step', total=self.num_timesteps):
-                img = self.p_sample(img, i, condition_x=x)
-                if i % sample_inter == 0:
-                    ret_img = torch.cat([ret_img, img], dim=0)
+            condition_x = x_in
+            first = x_in
+            if start_timestep is not None and start_timestep < self.num_timesteps - 1:
+                # truncated reverse process from q(x_t | x_0 = condition), decided by the
+                # strength alone so explicit timesteps lists starting below T-1 are truncated too
+                timesteps = [t for t in timesteps if t <= start_timestep] or [start_timestep]
+                img = self.q_sample(
+                    x_in, self.sqrt_alphas_cumprod[timesteps[0]], noise=self.sample_noise(x_in))
+                self.condition_start_timestep = timesteps[0]
+            else:
+                img = self.sample_noise(x_in)
+        batch_size = img.shape[0]
+        self.sample_steps_used = [len(timesteps)] * batch_size
+        early_stop = self.early_stop_threshold > 0 and len(timesteps) > 1
+        if early_stop:
+            # finished images are written to out and dropped from img, active maps
+            # the rows of img back to the batch
+            out = img.clone()
+            active = torch.arange(batch_size, device=device)
+            prev_x_recon = None
+
         if continous:
-            return ret_img
-        else:
-            return ret_img[-1]
+            if recorder is None:
+                recorder = TrajectoryRecorder()
+            recorder.begin(first, timesteps, sample_inter=(1 | (len(timesteps)//10)))
+
+        self.build_noise_cache(timesteps)
+        # early stopping shrinks the batch, which would recompile the graph at every new size
+        self.use_compiled = self.compiled_denoise_fn is not None and not early_stop and \
+            self.noise_cache_timesteps is not None
+        if condition_x is not None and hasattr(self.denoise_fn, 'cache_condition'):
+            self.denoise_fn.cache_condition(condition_x)
+            self.condition_cached = True
+        deep_cache = self.deep_cache_interval > 1 and hasattr(self.denoise_fn, 'enable_deep_cache') and \
+            not self.use_compiled
+        if deep_cache:
+            self.denoise_fn.enable_deep_cache(self.deep_cache_levels)
+        timesteps_prev = timesteps[1:] + [-1]
+        try:
+            for i, (t, t_prev) in enumerate(tqdm(zip(timesteps, timesteps_prev), desc=desc, total=len(timesteps))):
+                if deep_cache:
+                    self.denoise_fn.deep_cache_refresh = i % self.deep_cache_interval == 0
+                if not early_stop:
+                    img = step_fn(img, t, t_prev, condition_x=condition_x)
+                    if continous:
+                        recorder.record(t, img)
+                    continue
+
+                if len(active) > 0:
+                    img = step_fn(img, t, t_prev, condition_x=condition_x)
+                    x_recon = self.x_recon
+                    if prev_x_recon is not None and t_prev >= 0:
+                        change = (x_recon - prev_x_recon).abs().flatten(1).mean(1) / \
+                            (self.sqrt_alphas_cumprod[t] - self.sqrt_alphas_cumprod[prev_t]).abs()
+                        done = change < self.early_stop_threshold
+                        if done.any():
+                            # deterministic jump to t=0 with the current x_0 estimate
+                            out[active[done]] = x_recon[done]
+                            for b in active[done].tolist():
+                                self.sample_steps_used[b] = i + 1
+                            keep = (~done).nonzero().squeeze(1)
+                            active, img, x_recon = active[keep], img[keep], x_recon[keep]
+                            if condition_x is not None:
+                                condition_x = condition_x[keep]
+                            if self.condition_cached:
+                                self.denoise_fn.select_condition(keep)
+                            if deep_cache:
+                                self.denoise_fn.select_deep_cache(keep)
+                            if self.generators is not None:
+                                self.generators = [self.generators[b] for b in keep.tolist()]
+                            if hasattr(step_fn, 'select'):
+                                step_fn.select(keep)
+                    prev_x_recon, prev_t = x_recon, t
+                    out[active] = img
+                if continous:
+                    recorder.record(t, out)
+        finally:
+            if self.condition_cached:
+                self.denoise_fn.clear_condition_cache()
+                self.condition_cached = False
+            if deep_cache:
+                self.denoise_fn.disable_deep_cache()
+            self.use_compiled = False
+            self.generators = None
+
+        if early_stop:
+            img = out
+        if continous and recorder.sink is None:
+            return recorder.frames()
+        return img
+
+    @torch.no_grad()
+    def p_sample_loop(self, x_in, continous=False, recorder=None, start_timestep=None, seeds=None):
+        timesteps, step_fn, desc = self.get_sampler()
+        return self.sample_loop(
+            x_in, timesteps, step_fn, continous, recorder, desc=desc, start_timestep=start_timestep, seeds=seeds)
 
     @torch.no_grad()
-    def sample(self, batch_size=1, continous=False):
+    def sample(self, batch_size=1, continous=False, recorder=None):
         image_size = self.image_size
         channels = self.channels
-        return self.p_sample_loop((batch_size, channels, image_size, image_size), continous)
+        return self.p_sample_loop((batch_size, channels, image_size, image_size), continous, recorder)
 
     @torch.no_grad()
-    def super_resolution(self, x_in, continous=False):
-        return self.p_sample_loop(x_in, continous)
+    def super_resolution(self, x_in, continous=False, recorder=None, strength=None, start_timestep=None,
+                         seeds=None):
+        # strength (or an explicit start_timestep) truncates the reverse process,
+        # both default to the strength of the current schedule. seeds gives every
+        # image of the batch its own noise generator
+        if start_timestep is None:
+            start_timestep = self.start_timestep(default(strength, self.strength))
+        return self.p_sample_loop(x_in, continous, recorder, start_timestep, seeds)
 
     def q_sample(self, x_start, continuous_sqrt_alpha_cumprod, noise=None):
         noise = default(noise, lambda: torch.randn_like(x_start))
@@ -242,7 +610,46 @@ class GaussianDiffusion(nn.Module):
             x_recon = self.denoise_fn(
                 torch.cat([x_in['SR'], x_noisy], dim=1), continuous_sqrt_alpha_cumprod)
 
-        loss = self.loss_func(noise, x_recon)
+        # the loss is reduced in fp32 when the forward pass runs under autocast
+        loss = self.loss_func(noise, x_recon.float())
+        return loss
+
+    def distill_losses(self, x_in, teacher, timesteps):
+        '''
+        Progressive distillation: one deterministic DDIM step of this model from
+        timesteps[2i] must match two teacher steps timesteps[2i] -> [2i+1] -> [2i+2].
+        The loss is taken on x_0 with truncated-SNR weighting, max(SNR, 1) for l2.
+        '''
+        x_start = x_in['HR']
+        condition_x = x_in['SR'] if self.conditional else None
+        i = 2 * np.random.randint(0, (len(timesteps) + 1) // 2)
+        t = timesteps[i]
+        t_mid = timesteps[i + 1] if i + 1 < len(timesteps) else -1
+        t_next = timesteps[i + 2] if i + 2 < len(timesteps) else -1
+
+        noise = torch.randn_like(x_start)
+        x_noisy = self.q_sample(x_start, self.sqrt_alphas_cumprod[t], noise=noise)
+        with torch.no_grad():
+            x_mid = teacher.ddim_sample(x_noisy, t, t_mid, condition_x=condition_x)
+            if t_mid < 0:
+                x_target = x_mid
+            else:
+                x_next = teacher.ddim_sample(x_mid, t_mid, t_next, condition_x=condition_x)
+                if t_next < 0:
+                    x_target = x_next
+                else:
+                    # x_0 that takes x_noisy to x_next in a single DDIM step
+                    ratio = self.sqrt_one_minus_alphas_cumprod[t_next] / self.sqrt_one_minus_alphas_cumprod[t]
+                    x_target = (x_next - ratio * x_noisy) / \
+                        (self.sqrt_alphas_cumprod[t_next] - ratio * self.sqrt_alphas_cumprod[t])
+
+        # a noise error becomes an x_0 error sigma/alpha times larger, up to ~150x at the
+        # high-noise end, so x_0 is matched directly. Scaling both sides by max(alpha/sigma, 1)
+        # keeps the weight of the noise loss at low noise and never drops below the x_0 loss.
+        noise = self.predict_noise(x_noisy, t, condition_x=condition_x)
+        x_recon = self.predict_start_from_noise(x_noisy, t=t, noise=noise.float())
+        scale = (self.sqrt_alphas_cumprod[t] / self.sqrt_one_minus_alphas_cumprod[t]).clamp(min=1.)
+        loss = self.loss_func(scale * x_target, scale * x_recon)
         return loss
 
     def forward(self, x, *args, **kwargs):
@@ -0,0 +1,74 @@
+import inspect
+import numpy as np
+import os
+import torch
+from torch import nn
+
+
+class ExportableDenoiser(nn.Module):
+    '''UNet with separate (x_t, condition, noise_level) inputs, the signature of the exported graph'''
+
+    def __init__(self, unet):
+        super().__init__()
+        self.unet = unet
+
+    def forward(self, x_t, condition, noise_level):
+        return self.unet(torch.cat([condition, x_t], dim=1), noise_level)
+
+
+def export(unet, path, image_size, channels, opset_version=17):
+    '''export the denoiser to ONNX with a dynamic batch dimension'''
+    denoiser = ExportableDenoiser(unet).eval()
+    example = (torch.randn(1, channels, image_size, image_size),
+               torch.randn(1, channels, image_size, image_size),
+               torch.rand(1, 1))
+    batch = {0: 'batch'}
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    # the TorchScript exporter writes a single self-contained file, newer torch defaults to dynamo
+    kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    torch.onnx.export(
+        denoiser, example, path, opset_version=opset_version, **kwargs,
+        input_names=['x_t', 'condition', 'noise_level'], output_names=['noise'],
+        dynamic_axes={'x_t': batch, 'condition': batch, 'noise_level': batch, 'noise': batch})
+
+
+class OnnxDenoiser(nn.Module):
+    '''
+    Drop-in denoise_fn for GaussianDiffusion that runs an exported graph on the
+    onnxruntime CPU execution provider. It follows the condition cache protocol of
+    UNet, so the sampling loops hand it the condition once per batch.
+    '''
+
+    def __init__(self, path, threads=None):
+        super().__init__()
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.channels = self.session.get_inputs()[0].shape[1]
+        self.condition_cache = None
+
+    def cache_condition(self, condition_x):
+        self.condition_cache = condition_x.float().cpu().numpy()
+
+    def select_condition(self, index):
+        self.condition_cache = self.condition_cache[index.cpu().numpy()]
+
+    def clear_condition_cache(self):
+        self.condition_cache = None
+
+    def forward(self, x, noise_level):
+        if self.condition_cache is not None and x.shape[1] == self.channels:
+            x_t, condition = np.ascontiguousarray(x.float().cpu().numpy()), self.condition_cache
+        else:
+            # concatenated [condition, x_t] input, as given to UNet
+            x_np = x.float().cpu().numpy()
+            x_t = np.ascontiguousarray(x_np[:, -self.channels:])
+            condition = np.ascontiguousarray(x_np[:, :-self.channels])
+        noise, = self.session.run(None, {
+            'x_t': x_t, 'condition': condition,
+            'noise_level': noise_level.float().cpu().numpy().reshape(-1, 1)})
+        return torch.from_numpy(noise).to(x.device)
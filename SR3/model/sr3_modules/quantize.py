@@ -0,0 +1,43 @@
+import warnings
+import torch
+from torch import nn
+import torch.ao.quantization as tq
+
+
+def quantizable_convs(unet):
+    '''3x3 convs and the 1x1 convs of SelfAttention, the first and last convs stay fp32'''
+    skip = {id(unet.downs[0]), id(unet.final_conv.block[-1])}
+    for parent in list(unet.modules()):
+        for name, child in parent.named_children():
+            if isinstance(child, nn.Conv2d) and id(child) not in skip:
+                yield parent, name, child
+
+
+def prepare_int8(unet, backend='x86'):
+    '''
+    Wrap the quantizable convs between quant/dequant stubs with observers. Run the
+    denoiser on calibration data to record activation ranges, then call convert_int8.
+    '''
+    torch.backends.quantized.engine = backend
+    qconfig = tq.get_default_qconfig(backend)
+    for parent, name, conv in list(quantizable_convs(unet)):
+        wrapper = tq.QuantWrapper(conv)
+        wrapper.qconfig = qconfig
+        setattr(parent, name, wrapper)
+    tq.prepare(unet, inplace=True)
+    return unet
+
+
+def convert_int8(unet):
+    '''static int8 convs from the calibrated observers, dynamic int8 Linear layers'''
+    tq.convert(unet, inplace=True)
+    tq.quantize_dynamic(unet, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return unet
+
+
+def build_int8(unet, backend='x86'):
+    '''quantized module structure of a saved int8 checkpoint, its weights and ranges come from the state dict'''
+    with warnings.catch_warnings():
+        # the observers are never run, load_state_dict replaces their default ranges
+        warnings.simplefilter('ignore', UserWarning)
+        return convert_int8(prepare_int8(unet, backend))
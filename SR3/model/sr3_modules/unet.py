@@ -3,6 +3,7 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 from inspect import isfunction
+from torch.utils.checkpoint import checkpoint
 
 
 def exists(x):
@@ -31,6 +32,13 @@ class PositionalEncoding(nn.Module):
         return encoding
 
 
+class CachedNoiseEmbed():
+    '''Row of UNet.noise_cache, every FeatureWiseAffine reads its own columns'''
+
+    def __init__(self, row):
+        self.row = row
+
+
 class FeatureWiseAffine(nn.Module):
     def __init__(self, in_channels, out_channels, use_affine_level=False):
         super(FeatureWiseAffine, self).__init__()
@@ -38,15 +46,22 @@ class FeatureWiseAffine(nn.Module):
         self.noise_func = nn.Sequential(
             nn.Linear(in_channels, out_channels*(1+self.use_affine_level))
         )
+        self.cache_slice = None
 
     def forward(self, x, noise_embed):
-        batch = x.shape[0]
+        if isinstance(noise_embed, CachedNoiseEmbed):
+            # same projection for the whole batch, broadcast over it
+            batch = 1
+            noise = noise_embed.row[self.cache_slice]
+        else:
+            batch = x.shape[0]
+            noise = self.noise_func(noise_embed)
         if self.use_affine_level:
-            gamma, beta = self.noise_func(noise_embed).view(
+            gamma, beta = noise.view(
                 batch, -1, 1, 1).chunk(2, dim=1)
             x = (1 + gamma) * x + beta
         else:
-            x = x + self.noise_func(noise_embed).view(batch, -1, 1, 1)
+            x = x + noise.view(batch, -1, 1, 1)
         return x
 
 
@@ -126,18 +141,16 @@ class SelfAttention(nn.Module):
         head_dim = channel // n_head
 
         norm = self.norm(input)
-        qkv = self.qkv(norm).view(batch, n_head, head_dim * 3, height, width)
-        query, key, value = qkv.chunk(3, dim=2)  # bhdyx
-
-        attn = torch.einsum(
-            "bnchw, bncyx -> bnhwyx", query, key
-        ).contiguous() / math.sqrt(channel)
-        attn = attn.view(batch, n_head, height, width, -1)
-        attn = torch.softmax(attn, -1)
-        attn = attn.view(batch, n_head, height, width, height, width)
+        # tokens last-dim contiguous so scaled_dot_product_attention can use a fused
+        # kernel instead of building the (hw)^2 score tensor
+        qkv = self.qkv(norm).view(batch, n_head, head_dim * 3, height * width)
+        qkv = qkv.transpose(-1, -2).contiguous()
+        query, key, value = qkv.chunk(3, dim=-1)  # bn(hw)d
 
-        out = torch.einsum("bnhwyx, bncyx -> bnchw", attn, value).contiguous()
-        out = self.out(out.view(batch, channel, height, width))
+        out = F.scaled_dot_product_attention(
+            query, key, value, scale=1. / math.sqrt(channel))  # bn(hw)d
+        out = out.transpose(-1, -2).reshape(batch, channel, height, width)
+        out = self.out(out)
 
         return out + input
 
@@ -170,9 +183,11 @@ class UNet(nn.Module):
         res_blocks=3,
         dropout=0,
         with_noise_level_emb=True,
-        image_size=128
+        image_size=128,
+        use_checkpoint=False
     ):
         super().__init__()
+        self.use_checkpoint = use_checkpoint
 
         if with_noise_level_emb:
             noise_level_channel = inner_channel
@@ -231,28 +246,144 @@ class UNet(nn.Module):
         self.ups = nn.ModuleList(ups)
 
         self.final_conv = Block(pre_channel, default(out_channel, in_channel), groups=norm_groups)
+        self.noise_cache = None
+        self.condition_cache = None
+        self.condition_cache_weight = None
+        self.deep_cache_split = None
+        self.deep_cache = None
+        self.deep_cache_refresh = True
+
+    @torch.no_grad()
+    def cache_condition(self, condition_x):
+        '''
+        The first convolution is linear, so its response to the condition channels
+        (bias included) is computed once per batch. forward then only convolves the
+        noisy image and adds the cached part.
+        '''
+        conv = self.downs[0]
+        n_cond = condition_x.shape[1]
+        self.condition_cache = F.conv2d(
+            condition_x, conv.weight[:, :n_cond], conv.bias, padding=conv.padding)
+        self.condition_cache_weight = conv.weight[:, n_cond:].contiguous()
+
+    def select_condition(self, index):
+        # keep the cached condition of the images still being sampled
+        self.condition_cache = self.condition_cache[index]
+
+    def clear_condition_cache(self):
+        self.condition_cache = None
+        self.condition_cache_weight = None
+
+    @torch.no_grad()
+    def cache_noise_levels(self, noise_levels):
+        '''
+        Precompute the noise level embedding and every FeatureWiseAffine projection
+        for a fixed set of noise levels [N]. forward(x, i) then uses row i of the cache.
+        '''
+        t = self.noise_level_mlp(noise_levels.view(-1))
+        projections = []
+        offset = 0
+        for module in self.modules():
+            if isinstance(module, FeatureWiseAffine):
+                projection = module.noise_func(t)
+                module.cache_slice = slice(offset, offset + projection.shape[1])
+                offset += projection.shape[1]
+                projections.append(projection)
+        self.noise_cache = torch.cat(projections, dim=1)
+
+    def clear_noise_cache(self):
+        self.noise_cache = None
+
+    def enable_deep_cache(self, levels=1):
+        '''
+        Deep feature reuse across sampling steps. Only the outer `levels` resolution levels
+        (the first levels of downs and the last ones of ups) run on every call, the input of
+        the outer ups is cached when deep_cache_refresh is set and reused otherwise.
+        '''
+        downsamples = [i for i, layer in enumerate(self.downs) if isinstance(layer, Downsample)]
+        upsamples = [i for i, layer in enumerate(self.ups) if isinstance(layer, Upsample)]
+        assert 0 < levels <= len(downsamples), \
+            'deep cache levels must be between 1 and {}'.format(len(downsamples))
+        self.deep_cache_split = (downsamples[levels - 1], upsamples[-levels] + 1)
+        self.deep_cache = None
+        self.deep_cache_refresh = True
+
+    def select_deep_cache(self, index):
+        # keep the cached features of the images still being sampled
+        if self.deep_cache is not None:
+            self.deep_cache = self.deep_cache[index]
+
+    def disable_deep_cache(self):
+        self.deep_cache_split = None
+        self.deep_cache = None
+
+    def run_block(self, layer, x, t, skip=None):
+        # the ups get the skip features concatenated to x
+        def block(x, t, skip):
+            return layer(x if skip is None else torch.cat((x, skip), dim=1), t)
+
+        if self.use_checkpoint and self.training and torch.is_grad_enabled():
+            # only the block inputs are kept, the concatenation and the activations
+            # inside the block are recomputed in the backward pass
+            return checkpoint(block, x, t, skip, use_reentrant=False)
+        return block(x, t, skip)
 
     def forward(self, x, time):
-        t = self.noise_level_mlp(time) if exists(
-            self.noise_level_mlp) else None
+        if isinstance(time, int):
+            # index into the noise levels given to cache_noise_levels
+            t = CachedNoiseEmbed(self.noise_cache[time])
+        else:
+            t = self.noise_level_mlp(time) if exists(
+                self.noise_level_mlp) else None
+        return self.denoise(x, t, self.condition_cache, self.condition_cache_weight)
+
+    def forward_cached(self, x, noise_row, condition=None, condition_weight=None):
+        '''
+        forward with a row of noise_cache and the cached condition conv given as tensors,
+        the signature compiled by GaussianDiffusion.compile_denoiser so the graph does not
+        specialize on the timestep index or on module attributes.
+        '''
+        return self.denoise(x, CachedNoiseEmbed(noise_row), condition, condition_weight)
+
+    def denoise(self, x, t, condition=None, condition_weight=None):
+        # only the noisy image is given when the condition part of the first conv is cached
+        use_condition_cache = condition is not None and \
+            x.shape[1] != self.downs[0].in_channels
+
+        # the layers between the split points are skipped when the deep features are reused
+        split_down, split_up = self.deep_cache_split or (len(self.downs), 0)
+        reuse = self.deep_cache_split is not None and not self.deep_cache_refresh and \
+            self.deep_cache is not None and self.deep_cache.shape[0] == x.shape[0]
 
         feats = []
-        for layer in self.downs:
-            if isinstance(layer, ResnetBlocWithAttn):
-                x = layer(x, t)
+        for i, layer in enumerate(self.downs):
+            if reuse and i == split_down:
+                break
+            if i == 0 and use_condition_cache:
+                x = F.conv2d(x, condition_weight, padding=layer.padding) + condition
+            elif isinstance(layer, ResnetBlocWithAttn):
+                x = self.run_block(layer, x, t)
             else:
                 x = layer(x)
             feats.append(x)
 
-        for layer in self.mid:
-            if isinstance(layer, ResnetBlocWithAttn):
-                x = layer(x, t)
-            else:
-                x = layer(x)
-
-        for layer in self.ups:
+        if not reuse:
+            for layer in self.mid:
+                if isinstance(layer, ResnetBlocWithAttn):
+                    x = self.run_block(layer, x, t)
+                else:
+                    x = layer(x)
+
+        for i, layer in enumerate(self.ups):
+            if reuse and i < split_up:
+                continue
+            if self.deep_cache_split is not None and i == split_up:
+                if reuse:
+                    x = self.deep_cache
+                else:
+                    self.deep_cache = x
             if isinstance(layer, ResnetBlocWithAttn):
-                x = layer(torch.cat((x, feats.pop()), dim=1), t)
+                x = self.run_block(layer, x, t, feats.pop())
             else:
                 x = layer(x)
 
@@ -0,0 +1,97 @@
+import torch
+import torch.nn as nn
+import data as Data
+import model as Model
+import argparse
+import logging
+import core.logger as Logger
+import os
+from model.sr3_modules.quantize import prepare_int8, convert_int8
+from benchmark_sampling import evaluate
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', type=str, default='config/eval_deblurring.json',
+                        help='JSON file for configuration')
+    parser.add_argument('-p', '--phase', type=str, choices=['val'], help='val(generation)', default='val')
+    parser.add_argument('-gpu', '--gpu_ids', type=str, default=None)
+    parser.add_argument('-debug', '-d', action='store_true')
+    parser.add_argument('-enable_wandb', action='store_true')
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='fp32 checkpoint (without _gen.pth), defaults to path.resume_state')
+    parser.add_argument('-o', '--out', type=str, required=True,
+                        help='int8 checkpoint to write (without _gen.pth)')
+    parser.add_argument('--calib_dataroot', type=str, default=None,
+                        help='LRHR frames used for calibration, defaults to the train dataset of the config')
+    parser.add_argument('--calib_len', type=int, default=300, help='number of calibration frames')
+    parser.add_argument('--data_len', type=int, default=-1,
+                        help='number of val images used for the quality report, -1 for the whole split')
+    parser.add_argument('--backend', type=str, choices=['x86', 'fbgemm', 'qnnpack'], default='x86')
+    parser.add_argument('--seed', type=int, default=0)
+
+    # parse configs
+    args = parser.parse_args()
+    opt = Logger.parse(args)
+    if args.checkpoint is not None:
+        opt['path']['resume_state'] = args.checkpoint
+    calib_opt = dict(opt['datasets']['train'], data_len=args.calib_len,
+                     batch_size=opt['datasets']['val']['batch_size'] or 1)
+    if args.calib_dataroot is not None:
+        calib_opt['dataroot'] = args.calib_dataroot
+    opt['datasets']['val']['data_len'] = args.data_len
+    opt['gpu_ids'] = []
+    # Convert to NoneDict, which return None for missing key.
+    opt = Logger.dict_to_nonedict(opt)
+    calib_opt = Logger.dict_to_nonedict(calib_opt)
+
+    Logger.setup_logger(None, opt['path']['log'],
+                        'quantize', level=logging.INFO, screen=True)
+    logger = logging.getLogger('base')
+    assert opt['path']['resume_state'], 'a checkpoint to quantize is needed'
+
+    # frames are read in val mode, without augmentation
+    calib_set = Data.create_dataset(calib_opt, 'val')
+    calib_loader = Data.create_dataloader(calib_set, calib_opt, 'val')
+    val_set = Data.create_dataset(opt['datasets']['val'], 'val')
+    val_loader = Data.create_dataloader(val_set, opt['datasets']['val'], 'val')
+    diffusion = Model.create_model(opt)
+    network = diffusion.netG.module if isinstance(diffusion.netG, nn.DataParallel) else diffusion.netG
+    diffusion.set_new_noise_schedule(opt['model']['beta_schedule']['val'], schedule_phase='val')
+
+    fp32 = evaluate(diffusion, val_loader, args.seed)
+
+    # activation ranges from the training distribution of noise levels
+    prepare_int8(network.denoise_fn, args.backend)
+    network.eval()
+    torch.manual_seed(args.seed)
+    with torch.no_grad():
+        for calib_data in calib_loader:
+            network.p_losses(diffusion.set_device(calib_data))
+    convert_int8(network.denoise_fn)
+    logger.info('Calibrated on {} frames.'.format(len(calib_set)))
+    # a new schedule phase drops the noise embeddings cached by the fp32 denoiser
+    diffusion.set_new_noise_schedule(opt['model']['beta_schedule']['val'], schedule_phase='val int8')
+
+    int8 = evaluate(diffusion, val_loader, args.seed)
+
+    state_dict = network.state_dict()
+    state_dict['quantization'] = {'backend': args.backend}
+    out_dir = os.path.dirname(args.out)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    torch.save(state_dict, '{}_gen.pth'.format(args.out))
+    # keep the training position and the distilled schedule, not the fp32 optimizer state
+    opt_path = '{}_opt.pth'.format(opt['path']['resume_state'])
+    opt_state = torch.load(opt_path, map_location='cpu') if os.path.exists(opt_path) else \
+        {'epoch': 0, 'iter': 0, 'scheduler': None}
+    opt_state['optimizer'] = None
+    torch.save(opt_state, '{}_opt.pth'.format(args.out))
+
+    size = [os.path.getsize('{}_gen.pth'.format(path)) / 2 ** 20
+            for path in (opt['path']['resume_state'], args.out)]
+    for name, (psnr, ssim, _, seconds), mb in zip(('fp32', 'int8'), (fp32, int8), size):
+        logger.info('# {:<5s} # {:7.1f} MB, sec/img: {:8.3f}, PSNR: {:.4e}, SSIM: {:.4e}'.format(
+            name, mb, seconds, psnr, ssim))
+    logger.info('PSNR drift: {:+.2e}, SSIM drift: {:+.2e}. Saved the int8 checkpoint to {}'.format(
+        int8[0] - fp32[0], int8[1] - fp32[1], args.out))
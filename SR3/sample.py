@@ -8,7 +8,6 @@ import core.metrics as Metrics
 from core.wandb_logger import WandbLogger
 from tensorboardX import SummaryWriter
 import os
-import numpy as np
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -110,9 +109,8 @@ if __name__ == "__main__":
                             sample_img, '{}/{}_{}_sr.png'.format(result_path, current_step, idx))
 
                         tb_logger.add_image(
-                            'Iter_{}'.format(current_step),
-                            np.transpose(sample_img, [2, 0, 1]),
-                            idx)
+                            'Iter_{}'.format(current_step), sample_img, idx,
+                            dataformats='HWC' if sample_img.ndim == 3 else 'HW')
 
                         if wandb_logger:
                             wandb_logger.log_image(f'validation_{idx}', sample_img)
@@ -143,20 +141,20 @@ if __name__ == "__main__":
             show_img_mode = 'grid'
             if show_img_mode == 'single':
                 # single img series
-                sample_img = visuals['SAM']  # uint8
+                sample_img = visuals['SAM'][0]  # uint8
                 sample_num = sample_img.shape[0]
                 for iter in range(0, sample_num):
                     Metrics.save_img(
                         Metrics.tensor2img(sample_img[iter]), '{}/{}_{}_sample_{}.png'.format(result_path, current_step, idx, iter))
             else:
                 # grid img
-                sample_img = Metrics.tensor2img(visuals['SAM'])  # uint8
+                sample_img = Metrics.tensor2img(visuals['SAM'][0])  # uint8
                 Metrics.save_img(
                     sample_img, '{}/{}_{}_sample_process.png'.format(result_path, current_step, idx))
                 Metrics.save_img(
-                    Metrics.tensor2img(visuals['SAM'][-1]), '{}/{}_{}_sample.png'.format(result_path, current_step, idx))
+                    Metrics.tensor2img(visuals['SAM'][0, -1]), '{}/{}_{}_sample.png'.format(result_path, current_step, idx))
             
-            sample_imgs.append(Metrics.tensor2img(visuals['SAM'][-1]))
+            sample_imgs.append(Metrics.tensor2img(visuals['SAM'][0, -1]))
 
         if wandb_logger:
             wandb_logger.log_images('eval_images', sample_imgs)
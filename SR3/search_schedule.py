@@ -0,0 +1,140 @@
+import torch.nn as nn
+import data as Data
+import model as Model
+import argparse
+import logging
+import core.logger as Logger
+import json
+import os
+import numpy as np
+from collections import OrderedDict
+from benchmark_sampling import evaluate
+
+
+def initial_timesteps(net, steps, spacing, start):
+    '''steps timesteps from start down to 0, spaced uniformly in time or in log-SNR'''
+    if spacing == 'uniform':
+        timesteps = np.linspace(0, start, steps).round().astype(np.int64)
+    else:
+        log_snr = log_snr_table(net)
+        targets = np.linspace(log_snr[0], log_snr[start], steps)
+        timesteps = np.abs(log_snr[None, :start + 1] - targets[:, None]).argmin(axis=1)
+    return np.unique(timesteps)[::-1].tolist()
+
+
+def log_snr_table(net):
+    # log-SNR of the continuous noise levels sqrt_alphas_cumprod_prev[t+1] fed to the denoiser
+    gammas = np.asarray(net.sqrt_alphas_cumprod_prev[1:], dtype=np.float64) ** 2
+    return np.log(gammas / (1. - gammas))
+
+
+def candidates(log_snr, timesteps, i, step):
+    '''timesteps strictly between the neighbours of timesteps[i], step of the way towards each of them in log-SNR'''
+    hi = timesteps[i - 1]
+    lo = timesteps[i + 1] if i + 1 < len(timesteps) else -1
+    t = timesteps[i]
+    found = []
+    for target in (log_snr[t] + step * (log_snr[max(lo, 0)] - log_snr[t]),
+                   log_snr[t] + step * (log_snr[hi] - log_snr[t])):
+        c = lo + 1 + int(np.abs(log_snr[lo + 1:hi] - target).argmin())
+        if c != t and c not in found:
+            found.append(c)
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', type=str, default='config/eval_deblurring.json',
+                        help='JSON file for configuration')
+    parser.add_argument('-p', '--phase', type=str, choices=['val'], help='val(generation)', default='val')
+    parser.add_argument('-gpu', '--gpu_ids', type=str, default=None)
+    parser.add_argument('-debug', '-d', action='store_true')
+    parser.add_argument('-enable_wandb', action='store_true')
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='checkpoint to search a schedule for, defaults to path.resume_state')
+    parser.add_argument('--dataroot', type=str, default=None,
+                        help='held-out LRHR dataroot, defaults to the val dataset of the config')
+    parser.add_argument('--data_len', type=int, default=20,
+                        help='number of held-out images scored per candidate schedule')
+    parser.add_argument('--steps', type=int, required=True, help='step budget K')
+    parser.add_argument('--sampler', type=str, choices=['ddim', 'dpm_solver'], default='ddim')
+    parser.add_argument('--timestep_spacing', type=str, choices=['uniform', 'logsnr'], default='logsnr',
+                        help='spacing of the schedule the search starts from')
+    parser.add_argument('--metric', type=str, choices=['psnr', 'ssim'], default='psnr')
+    parser.add_argument('--rounds', type=int, default=4,
+                        help='refinement sweeps, the move size is halved after each one')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', type=str, default=None,
+                        help='JSON file for the resulting beta_schedule.val entry')
+
+    # parse configs
+    args = parser.parse_args()
+    opt = Logger.parse(args)
+    if args.checkpoint is not None:
+        opt['path']['resume_state'] = args.checkpoint
+    if args.dataroot is not None:
+        opt['datasets']['val']['dataroot'] = args.dataroot
+    opt['datasets']['val']['data_len'] = args.data_len
+    # Convert to NoneDict, which return None for missing key.
+    opt = Logger.dict_to_nonedict(opt)
+
+    Logger.setup_logger(None, opt['path']['log'],
+                        'search', level=logging.INFO, screen=True)
+    logger = logging.getLogger('base')
+
+    val_set = Data.create_dataset(opt['datasets']['val'], 'val')
+    val_loader = Data.create_dataloader(val_set, opt['datasets']['val'], 'val')
+    diffusion = Model.create_model(opt)
+    net = diffusion.netG.module if isinstance(diffusion.netG, nn.DataParallel) else diffusion.netG
+
+    base_opt = OrderedDict(opt['model']['beta_schedule']['val'])
+    base_opt['sampler'] = args.sampler
+    base_opt['sample_steps'] = args.steps
+    diffusion.set_new_noise_schedule(base_opt, schedule_phase='search')
+    start = net.start_timestep(net.strength)
+    log_snr = log_snr_table(net)
+
+    scores = {}
+
+    def score(timesteps):
+        key = tuple(timesteps)
+        if key not in scores:
+            schedule_opt = OrderedDict(base_opt)
+            schedule_opt['timesteps'] = list(timesteps)
+            diffusion.set_new_noise_schedule(schedule_opt, schedule_phase='search {}'.format(key))
+            psnr, ssim, _, _ = evaluate(diffusion, val_loader, args.seed)
+            # below strength 1 every candidate must start from the noised condition at its first timestep
+            if start < net.num_timesteps - 1:
+                assert net.condition_start_timestep == timesteps[0], \
+                    'schedule {} did not start from q_sample(condition) at {}'.format(list(key), timesteps[0])
+            scores[key] = psnr if args.metric == 'psnr' else ssim
+            logger.info('# {} # PSNR: {:.4e}, SSIM: {:.4e}'.format(list(key), psnr, ssim))
+        return scores[key]
+
+    # greedy coordinate refinement in log-SNR, the first timestep stays at the start of the
+    # (possibly truncated) reverse process and every other one moves between its neighbours
+    best = initial_timesteps(net, args.steps, args.timestep_spacing, start)
+    best_score = score(best)
+    logger.info('Searching a {}-step {} schedule on {} images, start {:.4e}.'.format(
+        len(best), args.sampler, len(val_set), best_score))
+    step = 0.5
+    for sweep in range(args.rounds):
+        improved = False
+        for i in range(1, len(best)):
+            for c in candidates(log_snr, best, i, step):
+                timesteps = best[:i] + [c] + best[i + 1:]
+                s = score(timesteps)
+                if s > best_score:
+                    best, best_score, improved = timesteps, s, True
+        logger.info('Sweep {}: {} {}: {:.4e}'.format(sweep + 1, best, args.metric, best_score))
+        if not improved:
+            step /= 2
+
+    schedule_opt = OrderedDict(base_opt)
+    schedule_opt['sample_steps'] = len(best)
+    schedule_opt['timesteps'] = best
+    out = args.out or os.path.join(
+        opt['path']['results'], 'schedule_{}_{}.json'.format(args.sampler, len(best)))
+    with open(out, 'w') as f:
+        json.dump(schedule_opt, f, indent=4)
+    logger.info('Best {}: {:.4e}. Saved the beta_schedule.val entry to {}'.format(args.metric, best_score, out))
@@ -14,8 +14,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config', type=str, default='config/sr_sr3_16_128.json',
                         help='JSON file for configuration')
-    parser.add_argument('-p', '--phase', type=str, choices=['train', 'val'],
-                        help='Run either train(training) or val(generation)', default='train')
+    parser.add_argument('-p', '--phase', type=str, choices=['train', 'val', 'distill'],
+                        help='Run either train(training), val(generation) or distill(progressive distillation)',
+                        default='train')
     parser.add_argument('-gpu', '--gpu_ids', type=str, default=None)
     parser.add_argument('-debug', '-d', action='store_true')
     parser.add_argument('-enable_wandb', action='store_true')
@@ -75,17 +76,60 @@ if __name__ == "__main__":
         logger.info('Resuming training from epoch: {}, iter: {}.'.format(
             current_epoch, current_step))
 
-    diffusion.set_new_noise_schedule(
-        opt['model']['beta_schedule'][opt['phase']], schedule_phase=opt['phase'])
-    if opt['phase'] == 'train':
+    if opt['phase'] == 'distill':
+        diffusion.set_new_noise_schedule(
+            opt['model']['beta_schedule']['train'], schedule_phase='train')
+    else:
+        diffusion.set_new_noise_schedule(
+            opt['model']['beta_schedule'][opt['phase']], schedule_phase=opt['phase'])
+    if opt['phase'] == 'distill':
+        # halve the sampling steps every n_iter_per_round iterations until target_steps
+        n_iter_per_round = opt['train']['distill']['n_iter_per_round']
+        while True:
+            round_step = 0
+            while round_step < n_iter_per_round:
+                current_epoch += 1
+                for _, train_data in enumerate(train_loader):
+                    if round_step >= n_iter_per_round:
+                        break
+                    diffusion.feed_data(train_data)
+                    if not diffusion.optimize_parameters():
+                        # gradient accumulation, steps count optimizer steps
+                        continue
+                    current_step += 1
+                    round_step += 1
+                    # log
+                    if current_step % opt['train']['print_freq'] == 0:
+                        logs = diffusion.get_current_log()
+                        message = '<epoch:{:3d}, iter:{:8,d}> '.format(
+                            current_epoch, current_step)
+                        for k, v in logs.items():
+                            message += '{:s}: {:.4e} '.format(k, v)
+                            tb_logger.add_scalar(k, v, current_step)
+                        logger.info(message)
+
+                        if wandb_logger:
+                            wandb_logger.log_metrics(logs)
+
+            logger.info('Saving {:d}-step student.'.format(len(diffusion.distill_timesteps[::2])))
+            diffusion.save_network(current_epoch, current_step)
+            if wandb_logger and opt['log_wandb_ckpt']:
+                wandb_logger.log_checkpoint(current_epoch, current_step)
+            if not diffusion.next_distill_round():
+                break
+
+        logger.info('End of distillation.')
+    elif opt['phase'] == 'train':
         while current_step < n_iter:
             current_epoch += 1
             for _, train_data in enumerate(train_loader):
-                current_step += 1
-                if current_step > n_iter:
+                if current_step >= n_iter:
                     break
                 diffusion.feed_data(train_data)
-                diffusion.optimize_parameters()
+                if not diffusion.optimize_parameters():
+                    # gradient accumulation, steps count optimizer steps
+                    continue
+                current_step += 1
                 # log
                 if current_step % opt['train']['print_freq'] == 0:
                     logs = diffusion.get_current_log()
@@ -110,37 +154,36 @@ if __name__ == "__main__":
                     diffusion.set_new_noise_schedule(
                         opt['model']['beta_schedule']['val'], schedule_phase='val')
                     for _,  val_data in enumerate(val_loader):
-                        idx += 1
                         diffusion.feed_data(val_data)
                         diffusion.test(continous=False)
                         visuals = diffusion.get_current_visuals()
-                        sr_img = Metrics.tensor2img(visuals['SR'])  # uint8
-                        hr_img = Metrics.tensor2img(visuals['HR'])  # uint8
-                        lr_img = Metrics.tensor2img(visuals['LR'])  # uint8
-                        fake_img = Metrics.tensor2img(visuals['INF'])  # uint8
+                        sr_imgs = Metrics.tensor2imgs(visuals['SR'])  # uint8
+                        hr_imgs = Metrics.tensor2imgs(visuals['HR'])  # uint8
+                        lr_imgs = Metrics.tensor2imgs(visuals['LR'])  # uint8
+                        fake_imgs = Metrics.tensor2imgs(visuals['INF'])  # uint8
 
-                        # generation
-                        Metrics.save_img(
-                            hr_img, '{}/{}_{}_hr.png'.format(result_path, current_step, idx))
-                        Metrics.save_img(
-                            sr_img, '{}/{}_{}_sr.png'.format(result_path, current_step, idx))
-                        Metrics.save_img(
-                            lr_img, '{}/{}_{}_lr.png'.format(result_path, current_step, idx))
-                        Metrics.save_img(
-                            fake_img, '{}/{}_{}_inf.png'.format(result_path, current_step, idx))
-                        tb_logger.add_image(
-                            'Iter_{}'.format(current_step),
-                            np.transpose(np.concatenate(
-                                (fake_img, sr_img, hr_img), axis=1), [2, 0, 1]),
-                            idx)
-                        avg_psnr += Metrics.calculate_psnr(
-                            sr_img, hr_img)
+                        for sr_img, hr_img, lr_img, fake_img in zip(sr_imgs, hr_imgs, lr_imgs, fake_imgs):
+                            idx += 1
+                            # generation
+                            Metrics.save_img(
+                                hr_img, '{}/{}_{}_hr.png'.format(result_path, current_step, idx))
+                            Metrics.save_img(
+                                sr_img, '{}/{}_{}_sr.png'.format(result_path, current_step, idx))
+                            Metrics.save_img(
+                                lr_img, '{}/{}_{}_lr.png'.format(result_path, current_step, idx))
+                            Metrics.save_img(
+                                fake_img, '{}/{}_{}_inf.png'.format(result_path, current_step, idx))
+                            grid_img = np.concatenate((fake_img, sr_img, hr_img), axis=1)
+                            tb_logger.add_image(
+                                'Iter_{}'.format(current_step), grid_img, idx,
+                                dataformats='HWC' if grid_img.ndim == 3 else 'HW')
+                            avg_psnr += Metrics.calculate_psnr(
+                                sr_img, hr_img)
 
-                        if wandb_logger:
-                            wandb_logger.log_image(
-                                f'validation_{idx}', 
-                                np.concatenate((fake_img, sr_img, hr_img), axis=1)
-                            )
+                            if wandb_logger:
+                                wandb_logger.log_image(
+                                    f'validation_{idx}', grid_img
+                                )
 
                     avg_psnr = avg_psnr / idx
                     diffusion.set_new_noise_schedule(
@@ -180,47 +223,51 @@ if __name__ == "__main__":
         result_path = '{}'.format(opt['path']['results'])
         os.makedirs(result_path, exist_ok=True)
         for _,  val_data in enumerate(val_loader):
-            idx += 1
             diffusion.feed_data(val_data)
             diffusion.test(continous=True)
             visuals = diffusion.get_current_visuals()
 
-            hr_img = Metrics.tensor2img(visuals['HR'])  # uint8
-            lr_img = Metrics.tensor2img(visuals['LR'])  # uint8
-            fake_img = Metrics.tensor2img(visuals['INF'])  # uint8
+            hr_imgs = Metrics.tensor2imgs(visuals['HR'])  # uint8
+            lr_imgs = Metrics.tensor2imgs(visuals['LR'])  # uint8
+            fake_imgs = Metrics.tensor2imgs(visuals['INF'])  # uint8
+            final_imgs = Metrics.tensor2imgs(visuals['SR'][:, -1])  # uint8
 
-            sr_img_mode = 'grid'
-            if sr_img_mode == 'single':
-                # single img series
-                sr_img = visuals['SR']  # uint8
-                sample_num = sr_img.shape[0]
-                for iter in range(0, sample_num):
+            for b in range(len(hr_imgs)):
+                idx += 1
+                hr_img, lr_img, fake_img = hr_imgs[b], lr_imgs[b], fake_imgs[b]
+
+                sr_img_mode = 'grid'
+                if sr_img_mode == 'single':
+                    # single img series
+                    sr_img = visuals['SR'][b]  # uint8
+                    sample_num = sr_img.shape[0]
+                    for iter in range(0, sample_num):
+                        Metrics.save_img(
+                            Metrics.tensor2img(sr_img[iter]), '{}/{}_{}_sr_{}.png'.format(result_path, current_step, idx, iter))
+                else:
+                    # grid img
+                    sr_img = Metrics.tensor2img(visuals['SR'][b])  # uint8
                     Metrics.save_img(
-                        Metrics.tensor2img(sr_img[iter]), '{}/{}_{}_sr_{}.png'.format(result_path, current_step, idx, iter))
-            else:
-                # grid img
-                sr_img = Metrics.tensor2img(visuals['SR'])  # uint8
+                        sr_img, '{}/{}_{}_sr_process.png'.format(result_path, current_step, idx))
+                    Metrics.save_img(
+                        final_imgs[b], '{}/{}_{}_sr.png'.format(result_path, current_step, idx))
+
                 Metrics.save_img(
-                    sr_img, '{}/{}_{}_sr_process.png'.format(result_path, current_step, idx))
+                    hr_img, '{}/{}_{}_hr.png'.format(result_path, current_step, idx))
                 Metrics.save_img(
-                    Metrics.tensor2img(visuals['SR'][-1]), '{}/{}_{}_sr.png'.format(result_path, current_step, idx))
-
-            Metrics.save_img(
-                hr_img, '{}/{}_{}_hr.png'.format(result_path, current_step, idx))
-            Metrics.save_img(
-                lr_img, '{}/{}_{}_lr.png'.format(result_path, current_step, idx))
-            Metrics.save_img(
-                fake_img, '{}/{}_{}_inf.png'.format(result_path, current_step, idx))
+                    lr_img, '{}/{}_{}_lr.png'.format(result_path, current_step, idx))
+                Metrics.save_img(
+                    fake_img, '{}/{}_{}_inf.png'.format(result_path, current_step, idx))
 
-            # generation
-            eval_psnr = Metrics.calculate_psnr(Metrics.tensor2img(visuals['SR'][-1]), hr_img)
-            eval_ssim = Metrics.calculate_ssim(Metrics.tensor2img(visuals['SR'][-1]), hr_img)
+                # generation
+                eval_psnr = Metrics.calculate_psnr(final_imgs[b], hr_img)
+                eval_ssim = Metrics.calculate_ssim(final_imgs[b], hr_img)
 
-            avg_psnr += eval_psnr
-            avg_ssim += eval_ssim
+                avg_psnr += eval_psnr
+                avg_ssim += eval_ssim
 
-            if wandb_logger and opt['log_eval']:
-                wandb_logger.log_eval_data(fake_img, Metrics.tensor2img(visuals['SR'][-1]), hr_img, eval_psnr, eval_ssim)
+                if wandb_logger and opt['log_eval']:
+                    wandb_logger.log_eval_data(fake_img, final_imgs[b], hr_img, eval_psnr, eval_ssim)
 
         avg_psnr = avg_psnr / idx
         avg_ssim = avg_ssim / idx